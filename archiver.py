@@ -0,0 +1,87 @@
+from twitchApi import TwitchApi
+import watcher
+
+
+class TwitchArchiver:
+  """
+  여러 스트리머를 한 프로세스에서 처리함.
+  첫 번째 스트리머의 TwitchApi가 만든 database(writer), 토큰,
+  http client(connection pool, rate limit), 다운로드 엔진을
+  나머지 스트리머가 같이 사용하고, 다운로드는 하나의 스레드 풀에서
+  스트리머를 번갈아가며 처리함.
+
+  TwitchApi와 같은 이름의 메소드를 가지므로 main.py에서 같은 방법으로 사용함.
+  """
+  def __init__(
+    self,
+    databasePath: str,
+    clientId: str,
+    clientSecret: str,
+    streamerIds: list,
+    readSize: int,
+    proxy: str,
+    tokenCachePath: str = None,
+    printIp: bool = False,
+    unifiedTable: bool = None
+  ):
+    if len(streamerIds) == 0:
+      raise Exception("streamers are needed")
+    first = TwitchApi(databasePath, clientId, clientSecret, streamerIds[0], readSize, proxy, tokenCachePath, printIp, unifiedTable)
+    self.apis = [first] + [
+      TwitchApi(databasePath, clientId, clientSecret, streamerId, readSize, proxy, tokenCachePath, False, shared=first)
+      for streamerId in streamerIds[1:]
+    ]
+    self.database = first.database
+
+
+  def read_all_clips(self, from_database_date: bool, workers: int = 1, refresh_tiers: list = None):
+    # 같은 http client를 사용하므로 rate limit은 모든 스트리머가 나눠 씀
+    for api in self.apis:
+      print(f"[{api.loginName}] read clips")
+      api.read_all_clips(from_database_date, workers, refresh_tiers)
+
+
+  def download_clips_from_database(
+    self,
+    downloadDirectory: str,
+    concurrency: int,
+    saveJson: bool,
+    forceDownload: bool,
+    skipDownloadIfExists: bool,
+    minView: int,
+    maxClips: int,
+    order: str = 'rowid',
+    bandwidthLimit: int = 0,
+    hostConnections: int = 0,
+    autoTune: bool = False
+  ):
+    apis = {api.loginName: api for api in self.apis}
+    # 다운로드 엔진은 모든 스트리머가 같이 사용하므로 속도 제한도 합쳐서 적용됨
+    self.apis[0].downloader.configure(concurrency, bandwidthLimit, hostConnections, autoTune)
+    if skipDownloadIfExists == True:
+      for api in self.apis:
+        api.reconcile_inventory(downloadDirectory, saveJson)
+    def clip_handler(loginName, clip):
+      return apis[loginName].download_clip(clip, downloadDirectory, saveJson, skipDownloadIfExists)
+    self.database.iterate_incomplete_rows_of(
+      list(apis.keys()),
+      clip_handler,
+      concurrency,
+      minView,
+      maxClips,
+      forceDownload,
+      order
+    )
+
+
+  def write_json_from_database(self, downloadDirectory: str, concurrency: int, jsonIndex: str = None):
+    for api in self.apis:
+      api.write_json_from_database(downloadDirectory, concurrency, jsonIndex)
+
+
+  def verify_downloads(self, downloadDirectory: str, workers: int = None) -> int:
+    return sum([api.verify_downloads(downloadDirectory, workers) for api in self.apis])
+
+
+  def watch(self, downloadDirectory: str, concurrency: int, saveJson: bool, minView: int, minInterval: float, maxInterval: float):
+    watcher.watch(self.apis, downloadDirectory, concurrency, saveJson, minView, minInterval, maxInterval)
@@ -0,0 +1,339 @@
+"""
+twitch 계정이나 네트워크 없이 클립 목록 읽기와 다운로드 성능을 재는 벤치마크.
+
+별도 프로세스에서 helix api를 흉내내는 서버(oauth, users, clips 페이지와 rate limit 헤더)와
+클립 mp4 파일을 주는 서버를 띄우고, TwitchApi가 그 서버를 사용하도록 해서
+실제와 같은 경로(http client, database writer, 다운로드 엔진)로 실행함.
+
+python3 benchmark.py --clips 20000 --downloads 500 --file-size 2M
+"""
+import argparse
+import bisect
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+from downloader import parse_byte_size
+from metrics import registry
+from twitchApi import TwitchApi
+import windowPlanner
+
+
+BROADCASTER_ID = "10000"
+LOGIN_NAME = "benchmark"
+
+
+def make_clips(numOfClips: int, cdnUrl: str, seed: int = 0) -> list:
+  """
+  2016년 1월부터 지금까지 고르게 퍼진 클립 목록. created_at 오름차순.
+  """
+  generator = random.Random(seed)
+  started_at = datetime(2016, 1, 1)
+  seconds = int((datetime.now() - started_at).total_seconds())
+  clips = []
+  for i in range(numOfClips):
+    clip_id = f"Bench{i:010d}Clip"
+    created_at = started_at + timedelta(seconds=generator.randint(0, seconds))
+    clips.append({
+      "id": clip_id,
+      "url": f"https://clips.twitch.tv/{clip_id}",
+      "embed_url": f"https://clips.twitch.tv/embed?clip={clip_id}",
+      "broadcaster_id": BROADCASTER_ID,
+      "broadcaster_name": "Benchmark",
+      "creator_id": str(generator.randint(1, 100000)),
+      "creator_name": "creator",
+      "video_id": "",
+      "game_id": "0",
+      "language": "ko",
+      "title": f"benchmark clip {i}",
+      "view_count": generator.randint(0, 100000),
+      "created_at": windowPlanner.format_date(created_at),
+      "thumbnail_url": f"{cdnUrl}/AT-cm%7C{i}-preview-480x272.jpg",
+      "duration": 30.0,
+      "vod_offset": None,
+    })
+  clips.sort(key=lambda clip: clip['created_at'])
+  return clips
+
+
+def make_mp4(size: int) -> bytes:
+  """
+  ftyp, moov, mdat box로 이루어진 size 바이트의 mp4 모양 데이터.
+  """
+  ftyp = struct.pack('>I4s4sI4s4s', 24, b'ftyp', b'isom', 0x200, b'isom', b'mp41')
+  moov = struct.pack('>I4s', 1024, b'moov') + bytes(1024 - 8)
+  mdat_size = max(8, size - len(ftyp) - len(moov))
+  mdat = struct.pack('>I4s', mdat_size, b'mdat') + bytes(mdat_size - 8)
+  return ftyp + moov + mdat
+
+
+class RateLimit:
+  """
+  helix처럼 1분에 limit 만큼 채워지는 bucket. 남은 양과 다 채워지는 시간을 헤더로 알려줌.
+  """
+  def __init__(self, limit: int):
+    self.limit = limit
+    self.points = float(limit)
+    self.updated_at = time.time()
+    self.lock = threading.Lock()
+
+  def take(self):
+    with self.lock:
+      now = time.time()
+      self.points = min(self.limit, self.points + (now - self.updated_at) * self.limit / 60)
+      self.updated_at = now
+      allowed = self.points >= 1
+      if allowed:
+        self.points -= 1
+      reset = int(now + (self.limit - self.points) * 60 / self.limit) + 1
+      return (allowed, {
+        'Ratelimit-Limit': str(self.limit),
+        'Ratelimit-Remaining': str(int(self.points)),
+        'Ratelimit-Reset': str(reset),
+      })
+
+
+def make_helix_handler(clips: list, rateLimit: RateLimit, latency: float):
+  created_ats = [clip['created_at'] for clip in clips]
+
+  class HelixHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+      pass
+
+    def respond(self, status: int, body: dict, headers: dict = {}):
+      content = json.dumps(body).encode('utf-8')
+      self.send_response(status)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(content)))
+      for (key, value) in headers.items():
+        self.send_header(key, value)
+      self.end_headers()
+      self.wfile.write(content)
+
+    def do_POST(self):
+      self.rfile.read(int(self.headers.get('Content-Length', 0)))
+      if urlparse(self.path).path.endswith('/oauth2/token'):
+        return self.respond(200, {'access_token': 'benchmark', 'expires_in': 5000000, 'token_type': 'bearer'})
+      self.respond(404, {'error': 'Not Found'})
+
+    def do_GET(self):
+      url = urlparse(self.path)
+      query = {key: values[0] for (key, values) in parse_qs(url.query).items()}
+      (allowed, headers) = rateLimit.take()
+      if not allowed:
+        return self.respond(429, {'error': 'Too Many Requests', 'status': 429}, headers)
+      if latency > 0:
+        time.sleep(latency)
+
+      if url.path.endswith('/users'):
+        return self.respond(200, {'data': [{'id': BROADCASTER_ID, 'login': LOGIN_NAME}]}, headers)
+      if url.path.endswith('/clips'):
+        # helix처럼 한 조회 구간에 대해 RESULT_CAP개까지만 페이지를 넘겨줌
+        started = bisect.bisect_left(created_ats, query['started_at']) if 'started_at' in query else 0
+        ended = bisect.bisect_left(created_ats, query['ended_at']) if 'ended_at' in query else len(clips)
+        ended = min(ended, started + windowPlanner.RESULT_CAP)
+        offset = int(query.get('after') or 0)
+        size = int(query.get('first', 20))
+        page = clips[started + offset:min(ended, started + offset + size)]
+        pagination = {'cursor': str(offset + size)} if started + offset + size < ended else {}
+        return self.respond(200, {'data': page, 'pagination': pagination}, headers)
+      self.respond(404, {'error': 'Not Found'}, headers)
+
+  return HelixHandler
+
+
+def make_cdn_handler(content: bytes):
+  class CdnHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+      pass
+
+    def do_GET(self):
+      if not self.path.endswith('.mp4'):
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      offset = 0
+      range_header = self.headers.get('Range', '')
+      if range_header.startswith('bytes='):
+        offset = int(range_header[len('bytes='):].split('-')[0] or 0)
+        if offset >= len(content):
+          self.send_response(416)
+          self.send_header('Content-Range', f'bytes */{len(content)}')
+          self.send_header('Content-Length', '0')
+          self.end_headers()
+          return
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {offset}-{len(content) - 1}/{len(content)}')
+      else:
+        self.send_response(200)
+      self.send_header('Content-Type', 'video/mp4')
+      self.send_header('Content-Length', str(len(content) - offset))
+      self.end_headers()
+      view = memoryview(content)
+      for i in range(offset, len(content), 1024 * 1024):
+        self.wfile.write(view[i:i + 1024 * 1024])
+
+  return CdnHandler
+
+
+def run_mock_servers(numOfClips: int, fileSize: int, rateLimit: int, latency: float, ready):
+  """
+  helix 서버와 cdn 서버를 띄우고 (helix url, cdn url)을 ready 큐로 알려줌.
+  """
+  cdn = ThreadingHTTPServer(('127.0.0.1', 0), make_cdn_handler(make_mp4(fileSize)))
+  cdn.daemon_threads = True
+  cdnUrl = f"http://127.0.0.1:{cdn.server_address[1]}/clips"
+  clips = make_clips(numOfClips, cdnUrl)
+  helix = ThreadingHTTPServer(('127.0.0.1', 0), make_helix_handler(clips, RateLimit(rateLimit), latency))
+  helix.daemon_threads = True
+  threading.Thread(target=cdn.serve_forever, daemon=True).start()
+  ready.put((f"http://127.0.0.1:{helix.server_address[1]}", cdnUrl))
+  helix.serve_forever()
+
+
+def peak_rss() -> int:
+  """
+  이 프로세스의 최대 메모리 사용량(바이트). 알 수 없으면 0.
+  """
+  if resource == None:
+    return 0
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # macOS는 바이트, linux는 KB 단위
+  return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def run(
+  numOfClips: int,
+  numOfDownloads: int,
+  fileSize: int,
+  readSize: int,
+  crawlWorkers: int,
+  concurrency: int,
+  rateLimit: int,
+  latency: float,
+  workDirectory: str
+) -> dict:
+  ready = multiprocessing.Queue()
+  server = multiprocessing.Process(
+    target=run_mock_servers,
+    args=(numOfClips, fileSize, rateLimit, latency, ready),
+    daemon=True
+  )
+  server.start()
+  try:
+    (helixUrl, _) = ready.get(timeout=60)
+    TwitchApi.HELIX_URL = f"{helixUrl}/helix"
+    TwitchApi.OAUTH_URL = f"{helixUrl}/oauth2"
+
+    databasePath = os.path.join(workDirectory, 'benchmark.sqlite3')
+    downloadDirectory = os.path.join(workDirectory, 'clips')
+    twitchApi = TwitchApi(databasePath, 'benchmark', 'benchmark', LOGIN_NAME, readSize, None)
+
+    started_at = time.perf_counter()
+    twitchApi.read_all_clips(False, crawlWorkers)
+    crawl_seconds = time.perf_counter() - started_at
+    crawl_metrics = registry.to_dict()
+
+    started_at = time.perf_counter()
+    if numOfDownloads != 0:
+      twitchApi.download_clips_from_database(downloadDirectory, concurrency, False, False, False, -1, numOfDownloads)
+    download_seconds = time.perf_counter() - started_at
+    download_metrics = registry.to_dict()
+    twitchApi.database.close()
+
+    with sqlite3.connect(databasePath) as connection:
+      rows = connection.execute(f"SELECT count(*) FROM clips_{LOGIN_NAME}").fetchone()[0]
+      downloaded = connection.execute(f"SELECT count(*) FROM clips_{LOGIN_NAME} WHERE download_status = 1").fetchone()[0]
+  finally:
+    server.terminate()
+
+  counters = crawl_metrics['counters']
+  histograms = crawl_metrics['histograms']
+  listed = counters.get(f'crawl_clips_total{{streamer={LOGIN_NAME}}}', 0)
+  rows_committed = counters.get('db_rows_committed_total', 0)
+  db_seconds = sum([histograms.get(name, {}).get('sum', 0) for name in ('db_execute_seconds', 'db_commit_seconds')])
+  api_requests = sum([histogram['count'] for (name, histogram) in histograms.items() if name.startswith('api_request_seconds')])
+  downloaded_bytes = download_metrics['counters'].get('download_bytes_total', 0)
+  return {
+    'clips': numOfClips,
+    'rows': rows,
+    'api_requests': api_requests,
+    'api_retries': sum([value for (name, value) in counters.items() if name.startswith('api_retries_total')]),
+    'crawl_seconds': crawl_seconds,
+    'clips_listed_per_second': listed / crawl_seconds if crawl_seconds > 0 else 0,
+    # writer 스레드가 sqlite에 쓰는 데 실제로 쓴 시간 기준
+    'db_rows_per_second': rows_committed / db_seconds if db_seconds > 0 else 0,
+    'downloaded': downloaded,
+    'download_seconds': download_seconds,
+    'download_mb_per_second': downloaded_bytes / (1024 ** 2) / download_seconds if download_seconds > 0 else 0,
+    'peak_rss_mb': peak_rss() / (1024 ** 2),
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="offline benchmark with a mock helix api and clip cdn")
+  parser.add_argument("--clips", type=int, default=5000, help="the number of clips in the mock api. (default=5000)")
+  parser.add_argument("--downloads", type=int, default=200, help="the number of clips to download. -1 is all, 0 skips downloading. (default=200)")
+  parser.add_argument("--file-size", default="1M", help="size of each clip file. K, M, G units are allowed. (default=1M)")
+  parser.add_argument("--read-size", type=int, default=100, help="the number of clips per api request. (default=100)")
+  parser.add_argument("--crawl-workers", type=int, default=4, help="the number of date windows requested at once. (default=4)")
+  parser.add_argument("--concurrency", type=int, default=6, help="download concurrency. (default=6)")
+  parser.add_argument("--rate-limit", type=int, default=800, help="api requests per minute allowed by the mock api. (default=800)")
+  parser.add_argument("--latency", type=float, default=0, help="seconds added to each mock api response. (default=0)")
+  parser.add_argument("--directory", help="directory for the database and clip files. (default=temporary directory, removed after run)")
+  parser.add_argument("--output", help="also write results as json to this file")
+  args = parser.parse_args()
+
+  workDirectory = args.directory if args.directory != None else tempfile.mkdtemp(prefix='clip-benchmark-')
+  os.makedirs(workDirectory, exist_ok=True)
+  try:
+    results = run(
+      args.clips,
+      args.downloads,
+      parse_byte_size(args.file_size),
+      args.read_size,
+      args.crawl_workers,
+      args.concurrency,
+      args.rate_limit,
+      args.latency,
+      workDirectory,
+    )
+  finally:
+    if args.directory == None:
+      shutil.rmtree(workDirectory, ignore_errors=True)
+
+  print(f'''
+    Benchmark results
+      clips                   {results['clips']} ({results['rows']} rows in database)
+      api requests            {results['api_requests']} ({results['api_retries']} retries)
+      crawl                   {results['crawl_seconds']:.2f}s
+      clips listed / s        {results['clips_listed_per_second']:.1f}
+      db rows / s             {results['db_rows_per_second']:.1f}
+      downloaded              {results['downloaded']} clips in {results['download_seconds']:.2f}s
+      download MB / s         {results['download_mb_per_second']:.2f}
+      peak rss                {results['peak_rss_mb']:.1f}MB
+  ''')
+  if args.output != None:
+    with open(args.output, 'w', encoding='utf-8') as f:
+      json.dump(results, f, indent=2)
@@ -1,27 +1,70 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Executor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import atexit
+import queue
 import sqlite3
+import threading
+import time
 from tqdm import tqdm
 from datetime import datetime
 
-class Database:
-  def __init__(self, databasePath) -> None:
-    self.path = databasePath
-    self.connection: sqlite3.Connection = sqlite3.connect(databasePath)
-    self.connection.row_factory = sqlite3.Row # column mapped data
+from metrics import registry
+import migrate
 
-  def __del__(self):
-    self.connection.close()
 
+# (table column, clip key) 
+# api 응답의 키 순서나 추가된 키와 상관없이 이름으로 매핑함
+CLIP_COLUMNS = (
+  ('id', 'id'),
+  ('url', 'url'),
+  ('embed_url', 'embed_url'),
+  ('broadcaster_id', 'broadcaster_id'),
+  ('broadcaster_name', 'broadcaster_name'),
+  ('creater_id', 'creator_id'),
+  ('creater_name', 'creator_name'),
+  ('video_id', 'video_id'),
+  ('game_id', 'game_id'),
+  ('language', 'language'),
+  ('title', 'title'),
+  ('view_count', 'view_count'),
+  ('created_at', 'created_at'),
+  ('thumbnail_url', 'thumbnail_url'),
+  ('duration', 'duration'),
+  ('vod_offset', 'vod_offset'),
+  ('vod_url', 'vod_url'),
+  ('updated_at', 'updated_at'),
+)
 
-class ClipDatabase(Database):
-  def __init__(self, databasePath) -> None:
-    super().__init__(databasePath)
-  
-    
-  def create_table(self, loginName):
-    cursor = self.connection.cursor() 
-    cursor.execute(f'''
-CREATE TABLE IF NOT EXISTS clips_{loginName} (
+
+def clip_parameters(clip: dict) -> dict:
+  parameters = {column: clip.get(key, clip.get(column)) for (column, key) in CLIP_COLUMNS}
+  if parameters['vod_offset'] == None:
+    parameters['vod_offset'] = -1
+  return parameters
+
+
+# 점수 = 조회수 - (클립이 만들어진 지 지난 날 수 * SCORE_AGE_WEIGHT)
+# 모든 행에 같은 현재 시각이 더해지므로 순서는 아래 식과 같고
+# 현재 시각이 들어가지 않으므로 expression index로 만들 수 있음
+SCORE_AGE_WEIGHT = 10
+SCORE_EXPRESSION = f"(view_count + {SCORE_AGE_WEIGHT} * julianday(created_at))"
+
+# 다운로드 순서: (정렬 기준, 방향). 모두 인덱스로 정렬함
+DOWNLOAD_ORDERS = {
+  'rowid': ('_id', 'ASC'),
+  'views': ('view_count', 'DESC'),
+  'newest': ('created_at', 'DESC'),
+  'oldest': ('created_at', 'ASC'),
+  'score': (SCORE_EXPRESSION, 'DESC'),
+}
+
+
+# 모든 스트리머의 클립을 broadcaster_id로 구분해서 담는 테이블
+UNIFIED_TABLE = 'clips'
+
+
+def clip_table_query(table: str) -> str:
+  return f'''
+CREATE TABLE IF NOT EXISTS {table} (
   _id INTEGER PRIMARY KEY AUTOINCREMENT,
   id TEXT UNIQUE,
   url TEXT,
@@ -42,67 +85,413 @@ CREATE TABLE IF NOT EXISTS clips_{loginName} (
   vod_url TEXT,
   download_status INTEGER DEFAULT 0,
   download_path TEXT DEFAULT "",
+  updated_at TIMESTAMP,
+  relative_path TEXT DEFAULT "",
+  json_hash TEXT DEFAULT "",
+  file_size INTEGER DEFAULT -1,
+  download_method TEXT DEFAULT ""
+);
+'''
+
+
+def clip_index_queries(table: str, scopeColumn: str = None) -> list:
+  """
+  클립 테이블의 보조 인덱스
+  - created_at: MAX(created_at), 날짜 순서
+  - view_count: minView 조건
+  - download_status: 다운로드 된 클립 조회 (json 저장)
+  - score: 'score' 다운로드 순서
+  - pending: 아직 받지 않은 클립만 가진 partial index. 
+    다운로드 대상의 개수를 인덱스만으로 셀 수 있음
+
+  scopeColumn이 주어지면 모든 인덱스의 앞에 붙여서 (스트리머, 정렬 기준) 복합 인덱스로 만듦.
+  """
+  scope = f"{scopeColumn}, " if scopeColumn != None else ""
+  return [
+    f"CREATE INDEX IF NOT EXISTS idx_{table}_created_at ON {table}({scope}created_at)",
+    f"CREATE INDEX IF NOT EXISTS idx_{table}_view_count ON {table}({scope}view_count)",
+    f"CREATE INDEX IF NOT EXISTS idx_{table}_download_status ON {table}({scope}download_status)",
+    f"CREATE INDEX IF NOT EXISTS idx_{table}_score ON {table}({scope}{SCORE_EXPRESSION})",
+    f"CREATE INDEX IF NOT EXISTS idx_{table}_pending ON {table}({scope}view_count, download_status) WHERE download_status != 1",
+  ]
+
+
+def bounded_map(executor: Executor, callback, items, maxInFlight: int, inFlight: set = None):
+  """
+  items를 하나씩 executor에 넘기되 동시에 maxInFlight 개까지만 제출하고
+  끝난 순서대로 결과를 넘겨줌.
+  items 전체를 미리 future로 만들지 않으므로 메모리 사용량이 일정함.
+  inFlight가 주어지면 아직 결과를 넘겨주지 않은 future를 그 set에 담아둠.
+  """
+  in_flight = inFlight if inFlight != None else set()
+
+  def take_done():
+    (done, _) = wait(in_flight, return_when=FIRST_COMPLETED)
+    for future in done:
+      in_flight.discard(future)
+      yield future.result()
+
+  try:
+    for item in items:
+      while len(in_flight) >= maxInFlight:
+        yield from take_done()
+      in_flight.add(executor.submit(callback, item))
+    while len(in_flight) > 0:
+      yield from take_done()
+  finally:
+    for future in in_flight:
+      future.cancel()
+
+
+def round_robin(iterators: list):
+  """
+  여러 iterator에서 하나씩 번갈아가며 꺼내줌
+  """
+  iterators = [iter(iterator) for iterator in iterators]
+  while len(iterators) > 0:
+    remaining = []
+    for iterator in iterators:
+      try:
+        yield next(iterator)
+        remaining.append(iterator)
+      except StopIteration:
+        pass
+    iterators = remaining
+
+
+class Database:
+  def __init__(self, databasePath) -> None:
+    self.path = databasePath
+    self.connection: sqlite3.Connection = sqlite3.connect(databasePath, timeout=30)
+    self.connection.row_factory = sqlite3.Row # column mapped data
+    # writer 스레드가 쓰는 동안에도 읽을 수 있도록 함
+    self.connection.execute("PRAGMA journal_mode=WAL")
+
+  def __del__(self):
+    self.connection.close()
+
+
+class DatabaseWriter:
+  """
+  database 쓰기만 담당하는 스레드.
+  다른 스레드는 (sql, rows)를 큐에 넣기만 하고 기다리지 않음.
+  큐에 들어온 순서대로 executemany로 실행하고
+  batchSize 개의 행이 쌓이거나 flushInterval 초가 지나면 한 번에 commit함.
+  쓰다가 오류가 나면 commit하지 않은 작업을 rollback하고 이후 작업은 버림.
+  클립 쓰기가 실패했는데 뒤따르는 조회 구간 상태만 commit되면 다음 실행 때
+  그 클립들을 다시 받지 않으므로, 다음 executemany나 flush에서 오류를 알림.
+  """
+  CLOSE = object()
+
+  def __init__(self, databasePath: str, batchSize: int = 5000, flushInterval: float = 1.0, maxQueueSize: int = 256):
+    self.path = databasePath
+    self.batchSize = batchSize
+    self.flushInterval = flushInterval
+    self.queue = queue.Queue(maxsize=maxQueueSize)
+    self.error = None
+    self.error_raised = False
+    self.closed = False
+    self.thread = threading.Thread(target=self.__run, name="DatabaseWriter", daemon=True)
+    self.thread.start()
+    atexit.register(self.close)
+
+  def executemany(self, sql: str, rows: list):
+    if self.closed:
+      raise Exception("database writer is closed")
+    self.__raise_error()
+    if len(rows) > 0:
+      self.queue.put((sql, rows))
+
+  def flush(self):
+    """
+    지금까지 넣은 작업이 모두 commit될 때까지 기다림
+    """
+    if self.closed:
+      return
+    done = threading.Event()
+    self.queue.put(done)
+    done.wait()
+    self.__raise_error()
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    self.queue.put(self.CLOSE)
+    self.thread.join()
+    if not self.error_raised:
+      self.__raise_error()
+
+  def __raise_error(self):
+    if self.error != None:
+      self.error_raised = True
+      raise Exception(self.error)
+
+  def __run(self):
+    connection = sqlite3.connect(self.path, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    pending_rows = 0
+    last_commit = time.monotonic()
+
+    def commit():
+      nonlocal pending_rows, last_commit
+      try:
+        with registry.timer('db_commit_seconds'):
+          connection.commit()
+        registry.inc('db_rows_committed_total', pending_rows)
+      except Exception as e:
+        print(f"\n[{datetime.now()}] database commit error {e}", flush=True)
+        fail(e)
+      pending_rows = 0
+      last_commit = time.monotonic()
+
+    def fail(error: Exception):
+      self.error = error
+      try:
+        connection.rollback()
+      except Exception:
+        pass
+
+    while True:
+      timeout = None
+      if pending_rows > 0:
+        timeout = max(0.0, self.flushInterval - (time.monotonic() - last_commit))
+      try:
+        item = self.queue.get(timeout=timeout)
+      except queue.Empty:
+        commit()
+        continue
+
+      if item is self.CLOSE:
+        commit()
+        break
+      if isinstance(item, threading.Event):
+        commit()
+        item.set()
+        continue
+
+      if self.error != None:
+        # 오류가 난 뒤의 작업은 실행하지 않음
+        continue
+      (sql, rows) = item
+      try:
+        with registry.timer('db_execute_seconds'):
+          connection.executemany(sql, rows)
+      except Exception as e:
+        print(f"\n[{datetime.now()}] database write error {e}", flush=True)
+        fail(e)
+        pending_rows = 0
+        continue
+      pending_rows += len(rows)
+      if pending_rows >= self.batchSize:
+        commit()
+    connection.close()
+
+
+class ClipDatabase(Database):
+  """
+  클립은 스트리머마다 `clips_<loginName>` 테이블에 저장함.
+  unified면 모든 스트리머의 클립을 `clips` 테이블 하나에 저장하고 broadcaster_id로 구분함.
+  이 경우 스트리머가 달라도 같은 sql을 사용하므로 statement cache를 그대로 사용하고
+  여러 스트리머에 대한 조회도 테이블 하나에서 처리함.
+  unified가 None이면 `clips` 테이블이 있는지에 따라서 정함.
+  """
+  def __init__(self, databasePath, unified: bool = None) -> None:
+    super().__init__(databasePath)
+    self.writer: DatabaseWriter = None
+    self.writer_lock = threading.Lock()
+    if unified == None:
+      unified = self.table_exists(UNIFIED_TABLE)
+    self.unified = unified
+    # loginName -> broadcaster_id
+    self.broadcasterIds = {}
+    self.create_common_tables()
+  
+  
+  def __del__(self):
+    self.close()
+    super().__del__()
+  
+  
+  def get_writer(self) -> DatabaseWriter:
+    with self.writer_lock:
+      if self.writer == None:
+        self.writer = DatabaseWriter(self.path)
+      return self.writer
+  
+  
+  def flush(self):
+    """
+    writer에 넣은 작업이 모두 commit될 때까지 기다림
+    """
+    if self.writer != None:
+      self.writer.flush()
+  
+  
+  def close(self):
+    if self.writer != None:
+      self.writer.close()
+      self.writer = None
+      # 쓰기가 많았던 경우 인덱스 통계를 갱신해서 query planner가 참고하도록 함
+      try:
+        self.connection.execute("PRAGMA optimize")
+      except Exception as e:
+        pass
+  
+  
+  def create_common_tables(self):
+    cursor = self.connection.cursor()
+    cursor.execute('''
+CREATE TABLE IF NOT EXISTS clip_windows (
+  login_name TEXT,
+  started_at TEXT,
+  ended_at TEXT,
+  clip_count INTEGER,
+  updated_at TIMESTAMP,
+  PRIMARY KEY (login_name, started_at, ended_at)
+);
+''')
+    cursor.execute('''
+CREATE TABLE IF NOT EXISTS crawl_state (
+  login_name TEXT,
+  started_at TEXT,
+  ended_at TEXT,
+  status TEXT DEFAULT 'pending',
+  cursor TEXT DEFAULT '',
+  clip_count INTEGER DEFAULT 0,
+  updated_at TIMESTAMP,
+  PRIMARY KEY (login_name, started_at, ended_at)
+);
+''')
+    cursor.execute('''
+CREATE TABLE IF NOT EXISTS users (
+  broadcaster_id TEXT PRIMARY KEY,
+  login_name TEXT UNIQUE,
+  updated_at TIMESTAMP
+);
+''')
+    cursor.execute('''
+CREATE TABLE IF NOT EXISTS json_indexes (
+  path TEXT PRIMARY KEY,
+  hash TEXT,
   updated_at TIMESTAMP
 );
 ''')
     self.connection.commit()
     cursor.close()
+  
+    
+  def table_exists(self, table: str) -> bool:
+    cursor = self.connection.cursor()
+    row = cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table, )).fetchone()
+    cursor.close()
+    return row != None
 
 
-  def insert_item(self, loginName: str, clip: dict):
+  def table_name(self, loginName: str) -> str:
+    return UNIFIED_TABLE if self.unified else f"clips_{loginName}"
+
+
+  def scope(self, loginName: str) -> tuple:
+    """
+    (테이블 이름, 스트리머 조건, 조건의 parameter)
+    """
+    if not self.unified:
+      return (f"clips_{loginName}", "1", ())
+    if loginName not in self.broadcasterIds:
+      user = self.get_user(loginName=loginName)
+      if user == None:
+        raise Exception(f"broadcaster_id of {loginName} is unknown")
+      self.broadcasterIds[loginName] = user[0]
+    return (UNIFIED_TABLE, "broadcaster_id = ?", (self.broadcasterIds[loginName], ))
+
+
+  def create_table(self, loginName: str, broadcasterId: str = None):
+    if broadcasterId != None:
+      self.broadcasterIds[loginName] = broadcasterId
+    table = self.table_name(loginName)
+    exists = self.table_exists(table)
     cursor = self.connection.cursor() 
-    if clip['vod_offset'] == None:
-      clip['vod_offset'] = -1
-    clipValues = tuple(clip.values())
-    cursor.execute(f'''
-    INSERT OR IGNORE INTO clips_{loginName}(
-      id, url, embed_url, broadcaster_id, broadcaster_name,
-      creater_id, creater_name, video_id, game_id, language, 
-      title, view_count, created_at, thumbnail_url, duration, 
-      vod_offset, vod_url, updated_at
-    ) VALUES (
-      ?,?,?,?,?,
-      ?,?,?,?,?,
-      ?,?,?,?,?,
-      ?,?,?
-    ) ON CONFLICT (id) 
-    DO UPDATE SET updated_at=?, view_count=?;''', 
-    clipValues + (clip['updated_at'], clip['view_count'])
-    )
+    cursor.execute(clip_table_query(table))
+    self.connection.commit()
+    if exists:
+      # 이전 버전에서 만든 테이블이면 밀린 migration을 적용함
+      migrate.apply_migrations(self.connection, table)
+    else:
+      # 새로 만든 테이블은 이미 최신 형태임
+      migrate.create_version_table(self.connection)
+      migrate.set_version(self.connection, table, migrate.LATEST_VERSION)
+    for query in clip_index_queries(table, 'broadcaster_id' if self.unified else None):
+      cursor.execute(query)
     self.connection.commit()
     cursor.close()
+
+
+  def upsert_clip_query(self, loginName: str) -> str:
+    columns = ', '.join([column for (column, _) in CLIP_COLUMNS])
+    values = ', '.join([f':{column}' for (column, _) in CLIP_COLUMNS])
+    return f'''
+    INSERT OR IGNORE INTO {self.table_name(loginName)}({columns}) VALUES ({values}) 
+    ON CONFLICT (id) 
+    DO UPDATE SET updated_at=excluded.updated_at, view_count=excluded.view_count;'''
+
+
+  def insert_item(self, loginName: str, clip: dict):
+    self.insertmany_item(loginName, [clip])
     
   
   def insertmany_item(self, loginName: str, clips: list[dict]):
-    cursor = self.connection.cursor() 
-    for clip in clips:
-      if clip['vod_offset'] == None:
-        clip['vod_offset'] = -1
-      clipValues = tuple(clip.values())
-      cursor.execute(f'''
-      INSERT OR IGNORE INTO clips_{loginName}(
-        id, url, embed_url, broadcaster_id, broadcaster_name,
-        creater_id, creater_name, video_id, game_id, language, 
-        title, view_count, created_at, thumbnail_url, duration, 
-        vod_offset, vod_url, updated_at
-      ) VALUES (
-        ?,?,?,?,?,
-        ?,?,?,?,?,
-        ?,?,?,?,?,
-        ?,?,?
-      ) ON CONFLICT (id) 
-      DO UPDATE SET updated_at=?, view_count=?;''', 
-      clipValues + (clip['updated_at'], clip['view_count']))
-    self.connection.commit()
-    cursor.close()
+    """
+    writer 스레드에 넘기고 바로 리턴함.
+    database에 반영된 것을 읽어야 하면 flush()를 먼저 호출할 것.
+    """
+    self.get_writer().executemany(
+      self.upsert_clip_query(loginName), 
+      [clip_parameters(clip) for clip in clips]
+    )
   
   
+  def split_changed_clips(self, loginName: str, clips: list[dict]) -> tuple:
+    """
+    (database에 없는 클립, 조회수가 바뀐 클립) 목록.
+    조회수가 같은 클립은 다시 쓸 필요가 없으므로 어느 쪽에도 넣지 않음.
+    id의 unique 인덱스로 한 번에 조회함. (클립 수는 SQLITE_MAX_VARIABLE_NUMBER보다 작아야 함)
+    """
+    if len(clips) == 0:
+      return ([], [])
+    cursor = self.connection.cursor()
+    rows = cursor.execute(f'''
+    SELECT id, view_count FROM {self.table_name(loginName)} WHERE id IN ({', '.join(['?'] * len(clips))})
+    ''', [clip['id'] for clip in clips]).fetchall()
+    cursor.close()
+    view_counts = {row[0]: row[1] for row in rows}
+    new_clips = [clip for clip in clips if clip['id'] not in view_counts]
+    changed_clips = [clip for clip in clips if clip['id'] in view_counts and view_counts[clip['id']] != clip['view_count']]
+    return (new_clips, changed_clips)
+
+
+  def get_clips(self, loginName: str, ids: list) -> list[dict]:
+    """
+    id 목록에 해당하는 행. 순서는 _id 순서.
+    """
+    if len(ids) == 0:
+      return []
+    cursor = self.connection.cursor()
+    rows = cursor.execute(f'''
+    SELECT * FROM {self.table_name(loginName)} WHERE id IN ({', '.join(['?'] * len(ids))}) ORDER BY _id
+    ''', ids).fetchall()
+    cursor.close()
+    return [dict(row) for row in rows]
+
+
   def get_latest_created_at(self, loginName: str) -> str:
+    (table, scope, scope_parameters) = self.scope(loginName)
     cursor = self.connection.cursor()
     try:
       latest_created_at = cursor.execute(f'''
-        SELECT MAX(created_at) FROM clips_{loginName}
-      ''').fetchone()[0] # '2017-12-29T13:12:23Z'
+        SELECT MAX(created_at) FROM {table} WHERE {scope}
+      ''', scope_parameters).fetchone()[0] # '2017-12-29T13:12:23Z'
       created_at = datetime.fromisoformat(latest_created_at[:-1])
       return (created_at.year, created_at.month)
     except Exception as e:
@@ -111,38 +500,267 @@ CREATE TABLE IF NOT EXISTS clips_{loginName} (
       cursor.close()
 
   
-  def update_download_info(self, loginName:str, clip: dict):
-    cursor = self.connection.cursor() 
-    cursor.execute(f'''
-    UPDATE clips_{loginName} SET download_status=?, download_path=? WHERE _id=?
-    ''', (clip['download_status'], clip['download_path'], clip['_id']))
+  def get_user(self, broadcasterId: str = None, loginName: str = None):
+    """
+    저장된 (broadcaster_id, login_name). 없으면 None.
+    """
+    cursor = self.connection.cursor()
+    if broadcasterId != None:
+      row = cursor.execute("SELECT broadcaster_id, login_name FROM users WHERE broadcaster_id=?", (broadcasterId, )).fetchone()
+    else:
+      row = cursor.execute("SELECT broadcaster_id, login_name FROM users WHERE login_name=?", (loginName, )).fetchone()
+    cursor.close()
+    return tuple(row) if row != None else None
+
+
+  def save_user(self, broadcasterId: str, loginName: str):
+    cursor = self.connection.cursor()
+    # 이름을 바꾼 경우 이전 login_name을 가진 행을 지움
+    cursor.execute("DELETE FROM users WHERE login_name=? AND broadcaster_id != ?", (loginName, broadcasterId))
+    cursor.execute('''
+    INSERT INTO users(broadcaster_id, login_name, updated_at) VALUES (?,?,?)
+    ON CONFLICT (broadcaster_id) DO UPDATE SET login_name=excluded.login_name, updated_at=excluded.updated_at
+    ''', (broadcasterId, loginName, datetime.now()))
     self.connection.commit()
     cursor.close()
 
 
-  def iterate_incomplete_rows(self, loginName: str, callback, concurrency: int, minView: int, maxClips: int, forceDownload: bool = False):
+  def record_window(self, loginName: str, started_at: str, ended_at: str, clip_count: int):
+    """
+    조회한 구간의 클립 수를 기록함.
+    겹치는 이전 기록은 지워서 기록된 구간끼리는 겹치지 않도록 함.
+    writer를 통해서 해당 구간의 클립 다음에 기록됨.
+    """
+    writer = self.get_writer()
+    writer.executemany('''
+    DELETE FROM clip_windows WHERE login_name=? AND started_at < ? AND ended_at > ?
+    ''', [(loginName, ended_at, started_at)])
+    writer.executemany('''
+    INSERT INTO clip_windows(login_name, started_at, ended_at, clip_count, updated_at) VALUES (?,?,?,?,?)
+    ''', [(loginName, started_at, ended_at, clip_count, datetime.now())])
+
+
+  def get_windows(self, loginName: str) -> list:
+    """
+    기록된 (started_at, ended_at, clip_count, updated_at) 목록. started_at 오름차순.
+    updated_at은 해당 구간을 마지막으로 조회한 시간.
+    """
     cursor = self.connection.cursor()
-    row_length_query = f"SELECT count(*) FROM clips_{loginName} WHERE view_count >= ?"
+    rows = cursor.execute('''
+    SELECT started_at, ended_at, clip_count, updated_at FROM clip_windows WHERE login_name=? ORDER BY started_at
+    ''', (loginName, )).fetchall()
+    cursor.close()
+    return [(row[0], row[1], row[2], datetime.fromisoformat(row[3])) for row in rows]
+
+  
+  def start_crawl(self, loginName: str, windows: list):
+    """
+    새로운 조회를 시작함. 끝난 구간의 조회 상태는 지우고
+    windows [(started_at, ended_at)]를 pending으로 기록함.
+    끝나지 않았거나 실패한 구간은 이어서 요청할 수 있도록 남겨둠.
+    """
+    writer = self.get_writer()
+    writer.executemany("DELETE FROM crawl_state WHERE login_name=? AND status NOT IN ('pending', 'failed')", [(loginName, )])
+    self.add_crawl_windows(loginName, windows)
+
+
+  def add_crawl_windows(self, loginName: str, windows: list):
+    now = datetime.now()
+    self.get_writer().executemany('''
+    INSERT OR REPLACE INTO crawl_state(login_name, started_at, ended_at, status, cursor, clip_count, updated_at) 
+    VALUES (?,?,?,'pending','',0,?)
+    ''', [(loginName, started_at, ended_at, now) for (started_at, ended_at) in windows])
+
+
+  def checkpoint_crawl_window(self, loginName: str, started_at: str, ended_at: str, status: str, cursor: str, clip_count: int):
+    """
+    구간의 상태와 다음 페이지 cursor를 기록함.
+    writer를 통해서 해당 페이지의 클립 다음에 기록되므로
+    cursor가 저장된 클립보다 앞서지 않음.
+    """
+    self.get_writer().executemany('''
+    UPDATE crawl_state SET status=?, cursor=?, clip_count=?, updated_at=? 
+    WHERE login_name=? AND started_at=? AND ended_at=?
+    ''', [(status, cursor, clip_count, datetime.now(), loginName, started_at, ended_at)])
+
+
+  def fail_crawl_window(self, loginName: str, started_at: str, ended_at: str):
+    """
+    마지막 cursor는 그대로 두고 실패로 표시함
+    """
+    self.get_writer().executemany('''
+    UPDATE crawl_state SET status='failed', updated_at=? WHERE login_name=? AND started_at=? AND ended_at=?
+    ''', [(datetime.now(), loginName, started_at, ended_at)])
+
+
+  def get_unfinished_crawl_windows(self, loginName: str) -> list:
+    """
+    이전 조회에서 끝나지 않았거나 실패한 구간.
+    [(started_at, ended_at, status, cursor, clip_count)]
+    """
+    self.flush()
+    cursor = self.connection.cursor()
+    rows = cursor.execute('''
+    SELECT started_at, ended_at, status, cursor, clip_count FROM crawl_state 
+    WHERE login_name=? AND status IN ('pending', 'failed') ORDER BY started_at
+    ''', (loginName, )).fetchall()
+    cursor.close()
+    return [tuple(row) for row in rows]
+
+
+  def update_download_info(self, loginName:str, clip: dict):
+    """
+    writer 스레드에 넘기고 바로 리턴함.
+    writer가 batchSize 개 또는 flushInterval 초마다 한 번에 commit함.
+    """
+    self.update_download_infos(loginName, [clip])
+
+
+  def update_download_infos(self, loginName:str, clips: list[dict]):
+    self.get_writer().executemany(f'''
+    UPDATE {self.table_name(loginName)} SET download_status=?, download_path=?, relative_path=?, json_hash=?, file_size=?, download_method=? WHERE _id=?
+    ''', [
+      (clip['download_status'], clip['download_path'], clip.get('relative_path', ''), clip.get('json_hash', ''), clip.get('file_size', -1), clip.get('download_method', ''), clip['_id']) 
+      for clip in clips
+    ])
+
+
+  def update_file_sizes(self, loginName: str, sizes: list):
+    """
+    [(_id, 파일 크기)]. 크기가 기록되지 않은 예전 클립의 크기를 검사한 뒤에 채움.
+    """
+    self.get_writer().executemany(f'''
+    UPDATE {self.table_name(loginName)} SET file_size=? WHERE _id=?
+    ''', [(size, _id) for (_id, size) in sizes])
+
+
+  def reset_download_status(self, loginName: str, ids: list):
+    """
+    검사에 실패한 클립을 한 번에 다운로드 대상으로 되돌림.
+    file_size는 다음 다운로드와 비교할 수 있도록 그대로 둠.
+    """
+    self.get_writer().executemany(f'''
+    UPDATE {self.table_name(loginName)} SET download_status=0 WHERE _id=?
+    ''', [(_id, ) for _id in ids])
+
+
+  def update_json_hashes(self, loginName: str, clips: list[dict]):
+    """
+    json 파일에 쓴 내용의 hash를 기록함. 다음에 내용이 같으면 다시 쓰지 않음.
+    """
+    self.get_writer().executemany(f'''
+    UPDATE {self.table_name(loginName)} SET json_hash=? WHERE _id=?
+    ''', [(clip['json_hash'], clip['_id']) for clip in clips])
+
+
+  def get_json_index_hashes(self) -> dict:
+    """
+    path -> 마지막으로 쓴 index 파일 내용의 hash
+    """
+    self.flush()
+    cursor = self.connection.cursor()
+    rows = cursor.execute("SELECT path, hash FROM json_indexes").fetchall()
+    cursor.close()
+    return {row[0]: row[1] for row in rows}
+
+
+  def save_json_index_hash(self, path: str, hash: str):
+    self.get_writer().executemany('''
+    INSERT INTO json_indexes(path, hash, updated_at) VALUES (?,?,?)
+    ON CONFLICT (path) DO UPDATE SET hash=excluded.hash, updated_at=excluded.updated_at
+    ''', [(path, hash, datetime.now())])
+
+
+  def iterate_rows(self, loginName: str, where: str, parameters: tuple = (), limit: int = -1, order: str = 'rowid', chunkSize: int = 500):
+    """
+    조건에 맞는 행을 order 순서대로 chunkSize 개씩 읽어서 dict로 하나씩 넘겨줌.
+    (정렬 기준, _id) 기준으로 이어서 읽으므로 읽는 도중에 행이 바뀌어도 
+    같은 행을 두 번 읽거나 건너뛰지 않고, 메모리에는 한 chunk만 올라감.
+    """
+    if order not in DOWNLOAD_ORDERS:
+      raise Exception(f"unknown order {order}. one of {list(DOWNLOAD_ORDERS.keys())}")
+    (key, direction) = DOWNLOAD_ORDERS[order]
+    comparison = '>' if direction == 'ASC' else '<'
+    (table, scope, scope_parameters) = self.scope(loginName)
+    parameters = scope_parameters + parameters
+    # sqlite는 row value 비교만으로는 expression index에서 위치를 찾지 못하므로
+    # 정렬 기준의 범위 조건을 같이 넣어서 이어서 읽을 위치부터 바로 찾도록 함
+    query = f'''
+    SELECT *, {key} AS _order_key FROM {table} 
+    WHERE ({scope}) AND ({where}) AND {key} {comparison}= ? AND ({key}, _id) {comparison} (?, ?) 
+    ORDER BY {key} {direction}, _id {direction} LIMIT ?'''
+    first_query = f'''
+    SELECT *, {key} AS _order_key FROM {table} 
+    WHERE ({scope}) AND ({where}) 
+    ORDER BY {key} {direction}, _id {direction} LIMIT ?'''
+    
+    cursor = self.connection.cursor()
+    last = None
+    count = 0
+    try:
+      while limit == -1 or count < limit:
+        size = chunkSize if limit == -1 else min(chunkSize, limit - count)
+        if last == None:
+          rows = cursor.execute(first_query, parameters + (size, )).fetchall()
+        else:
+          rows = cursor.execute(query, parameters + (last[0], ) + last + (size, )).fetchall()
+        if len(rows) == 0:
+          break
+        last = (rows[-1]['_order_key'], rows[-1]['_id'])
+        count += len(rows)
+        for row in rows:
+          clip = dict(row)
+          clip.pop('_order_key')
+          yield clip
+    finally:
+      cursor.close()
+
+
+  def iterate_incomplete_rows(self, loginName: str, callback, concurrency: int, minView: int, maxClips: int, forceDownload: bool = False, order: str = 'rowid'):
+    self.iterate_incomplete_rows_of(
+      [loginName], 
+      lambda _, clip: callback(clip), 
+      concurrency, 
+      minView, 
+      maxClips, 
+      forceDownload, 
+      order
+    )
+  
+  
+  def iterate_incomplete_rows_of(self, loginNames: list, callback, concurrency: int, minView: int, maxClips: int, forceDownload: bool = False, order: str = 'rowid'):
+    """
+    여러 스트리머의 다운로드 대상을 하나의 스레드 풀에서 처리함.
+    스트리머마다 order 순서로 읽은 행을 번갈아가며 넘겨주므로 
+    한 스트리머가 풀을 독차지하지 않음.
+    maxClips는 스트리머마다 적용됨.
+    callback(loginName, clip)은 다운로드 결과가 반영된 clip을 리턴해야 함.
+    """
+    cursor = self.connection.cursor()
+    where = "view_count >= ?"
     if forceDownload != True:
-      row_length_query += f" AND download_status != 1"
-    row_length = cursor.execute(row_length_query, (minView, )).fetchone()[0]
+      where += " AND download_status != 1"
+    row_length = 0
+    for loginName in loginNames:
+      (table, scope, scope_parameters) = self.scope(loginName)
+      count = cursor.execute(f"SELECT count(*) FROM {table} WHERE ({scope}) AND ({where})", scope_parameters + (minView, )).fetchone()[0]
+      row_length += count if maxClips == -1 else min(count, maxClips)
+    cursor.close()
     
-    if maxClips != -1 and maxClips < row_length:
-      row_length = maxClips
+    def streamer_rows(loginName):
+      for clip in self.iterate_rows(loginName, where, (minView, ), maxClips, order):
+        yield (loginName, clip)
+    rows = round_robin([streamer_rows(loginName) for loginName in loginNames])
     
-    query = f"SELECT * FROM clips_{loginName} WHERE view_count >= ?"
-    if forceDownload != True:
-      query += f" AND download_status != 1"
-    if maxClips != -1:
-      query += f" LIMIT {maxClips}"
-    cursor.execute(query, (minView, ))
+    def handler(item):
+      (loginName, clip) = item
+      return (loginName, callback(loginName, clip))
 
+    in_flight = set()
     with tqdm(total=row_length, unit='clip') as progress_bar:
       with ThreadPoolExecutor(max_workers=concurrency) as executor:
         try:
-          futures = [executor.submit(callback, dict(row)) for row in cursor]
-          for future in as_completed(futures):
-            clip = future.result()
+          for (loginName, clip) in bounded_map(executor, handler, rows, concurrency * 2, in_flight):
             self.update_download_info(loginName, clip)
             if clip['download_status'] == 1:
               progress_bar.set_description_str(f"[{loginName}] success to download {clip['created_at']}")
@@ -152,22 +770,29 @@ CREATE TABLE IF NOT EXISTS clips_{loginName} (
         except KeyboardInterrupt:
           print("KeyboardInterrupt! wait for currently running jobs.")
           executor.shutdown(wait=True, cancel_futures=True)
+          # 기다리는 동안 끝난 다운로드의 결과도 기록함
+          for future in in_flight:
+            if future.done() and not future.cancelled() and future.exception() == None:
+              (loginName, clip) = future.result()
+              self.update_download_info(loginName, clip)
           print("KeyboardInterrupt! exit")
-    cursor.close()
+        finally:
+          # 중단되어도 끝난 다운로드의 상태는 database에 남도록 함
+          self.flush()
   
   
   def iterate_completed_rows(self, loginName: str, callback, concurrency=10):
+    (table, scope, scope_parameters) = self.scope(loginName)
     cursor = self.connection.cursor()
+    row_length = cursor.execute(f"SELECT count(*) FROM {table} WHERE ({scope}) AND download_status = 1", scope_parameters).fetchone()[0]
+    cursor.close()
     
-    row_length = cursor.execute(f"SELECT count(*) FROM clips_{loginName} WHERE download_status = 1").fetchone()[0]
-    cursor.execute(f"SELECT * FROM clips_{loginName} WHERE download_status = 1")
+    rows = self.iterate_rows(loginName, "download_status = 1")
 
     with tqdm(total=row_length, unit='clip') as progress_bar:
       with ThreadPoolExecutor(max_workers=concurrency) as executor:
         try:
-          futures = [executor.submit(callback, dict(row)) for row in cursor]
-          for future in as_completed(futures):
-            (status, clip) = future.result()
+          for (status, clip) in bounded_map(executor, callback, rows, concurrency * 2):
             if status:
               progress_bar.set_description_str(f"[{loginName}] success to save json {clip['created_at']}")
               progress_bar.update(1)
@@ -177,5 +802,3 @@ CREATE TABLE IF NOT EXISTS clips_{loginName} (
           print("KeyboardInterrupt! wait for currently running jobs.")
           executor.shutdown(wait=True, cancel_futures=True)
           print("KeyboardInterrupt! exit")
-    cursor.close()
-
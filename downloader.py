@@ -0,0 +1,361 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import registry
+
+try:
+  from streamlink import Streamlink
+except ImportError:
+  Streamlink = None
+
+
+CHUNK_SIZE = 1024 * 1024
+# 받는 중인 파일. 다 받으면 확장자를 떼어냄
+PART_EXTENSION = '.part'
+# streamlink로 받는 중인 파일. vod_url의 Range 요청으로 이어서 받으면 안 되므로 따로 씀
+STREAMLINK_PART_EXTENSION = '.streamlink.part'
+
+
+def parse_byte_size(size: str) -> int:
+  """
+  '10M' -> 10485760. 단위는 K, M, G (1024 기준). 없거나 0 이하면 0.
+  """
+  if size == None:
+    return 0
+  size = str(size).strip().upper().rstrip('B')
+  if len(size) == 0:
+    return 0
+  units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+  if size[-1] in units:
+    return max(0, int(float(size[:-1]) * units[size[-1]]))
+  return max(0, int(float(size)))
+
+
+class BandwidthLimiter:
+  """
+  모든 다운로드 스레드가 공유하는 초당 바이트 수 제한 (token bucket).
+  받은 만큼 consume을 호출하면 제한을 넘은 만큼 잠듦.
+  bytesPerSecond가 0이면 제한하지 않고 받은 양만 셈.
+  """
+  def __init__(self, bytesPerSecond: int = 0, burst: float = 1.0):
+    self.bytesPerSecond = bytesPerSecond
+    self.capacity = bytesPerSecond * burst
+    self.tokens = self.capacity
+    self.updated_at = time.monotonic()
+    self.total_bytes = 0
+    self.lock = threading.Lock()
+
+  def consume(self, size: int):
+    with self.lock:
+      self.total_bytes += size
+      if self.bytesPerSecond <= 0:
+        return
+      now = time.monotonic()
+      self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.bytesPerSecond)
+      self.updated_at = now
+      # 모자란 만큼은 빚으로 두고 그만큼 잠듦
+      self.tokens -= size
+      wait = -self.tokens / self.bytesPerSecond if self.tokens < 0 else 0
+    if wait > 0:
+      time.sleep(wait)
+
+
+class AdaptiveGate:
+  """
+  동시에 다운로드하는 worker 수를 조절하는 semaphore.
+  autoTune이면 주기적으로 받은 속도를 재서 목표 속도보다 느리면 worker를 늘리고
+  목표 속도를 넘으면 줄임.
+  """
+  def __init__(self, limit: int, minimum: int = 1, maximum: int = None):
+    self.limit = limit
+    self.minimum = minimum
+    self.maximum = maximum if maximum != None else limit
+    self.active = 0
+    self.condition = threading.Condition()
+
+  def __enter__(self):
+    with self.condition:
+      while self.active >= self.limit:
+        self.condition.wait()
+      self.active += 1
+    return self
+
+  def __exit__(self, *args):
+    with self.condition:
+      self.active -= 1
+      self.condition.notify_all()
+
+  def resize(self, limit: int):
+    with self.condition:
+      self.limit = max(self.minimum, min(self.maximum, limit))
+      self.condition.notify_all()
+
+
+class DownloadEngine:
+  """
+  클립 다운로드를 worker 스레드 안에서 처리함.
+  - 저장된 vod_url을 keep-alive connection pool로 먼저 받고
+    실패하면 streamlink를 사용함
+  - 모든 방법은 `.part` 파일에 쓰고 다 받은 후에 이름을 바꾸므로
+    중간에 실패해도 완성되지 않은 `.mp4` 파일이 남지 않음.
+    streamlink는 vod_url과 다른 내용을 받으므로 `.streamlink.part`에 쓰고 실패하면 지움
+  - streamlink session은 스레드마다 하나씩 만들어서 재사용함
+  - `python -m streamlink` 프로세스 실행은 위 방법이 실패했을 때만 사용함
+  """
+  def __init__(self, proxy: str = None, poolSize: int = 32):
+    self.proxy = proxy
+    self.local = threading.local()
+    self.limiter = BandwidthLimiter()
+    self.gate = None
+    self.hostConnections = 0
+    self.hostSemaphores = {}
+    self.hostLock = threading.Lock()
+    self.tuner = None
+
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    self.session.mount("https://", adapter)
+    self.session.mount("http://", adapter)
+    if proxy != None:
+      self.session.proxies.update({
+        "http": proxy,
+        "https": proxy,
+      })
+
+  def configure(self, workers: int, bandwidthLimit: int = 0, hostConnections: int = 0, autoTune: bool = False, tuneInterval: float = 5.0):
+    """
+    bandwidthLimit: 모든 다운로드를 합친 초당 바이트 수. 0이면 제한 없음
+    hostConnections: 같은 host에 동시에 연결하는 수. 0이면 제한 없음
+    autoTune: bandwidthLimit을 목표 속도로 두고 동시에 받는 worker 수를 1 ~ workers 사이에서 조절함
+    """
+    self.limiter = BandwidthLimiter(bandwidthLimit)
+    self.hostConnections = hostConnections
+    self.hostSemaphores = {}
+    self.gate = None
+    if autoTune == True and bandwidthLimit > 0:
+      self.gate = AdaptiveGate(max(1, workers // 2), 1, workers)
+      if self.tuner == None:
+        self.tuner = threading.Thread(target=self.__tune, args=(tuneInterval, ), name="DownloadTuner", daemon=True)
+        self.tuner.start()
+
+  def __tune(self, interval: float):
+    limiter = self.limiter
+    last_bytes = limiter.total_bytes
+    while True:
+      time.sleep(interval)
+      gate = self.gate
+      if self.limiter is not limiter:
+        # configure로 limiter가 바뀌면 받은 양을 새로 셈
+        limiter = self.limiter
+        last_bytes = limiter.total_bytes
+        continue
+      total_bytes = limiter.total_bytes
+      rate = (total_bytes - last_bytes) / interval
+      last_bytes = total_bytes
+      if gate == None:
+        continue
+      target = limiter.bytesPerSecond
+      # 제한에 걸려서 기다리는 worker가 많으면 줄이고, 목표보다 느리면 늘림
+      if rate < target * 0.85 and gate.active >= gate.limit:
+        gate.resize(gate.limit + 1)
+      elif rate >= target * 0.98 and gate.limit > gate.minimum:
+        gate.resize(gate.limit - 1)
+
+  @contextmanager
+  def __host_slot(self, url: str):
+    if self.hostConnections <= 0:
+      yield
+      return
+    host = urlparse(url).netloc
+    with self.hostLock:
+      if host not in self.hostSemaphores:
+        self.hostSemaphores[host] = threading.BoundedSemaphore(self.hostConnections)
+      semaphore = self.hostSemaphores[host]
+    with semaphore:
+      yield
+
+  def __received(self, size: int):
+    self.limiter.consume(size)
+    registry.inc('download_bytes_total', size)
+
+  def __attempt(self, method: str, function, *args):
+    """
+    다운로드 방법 하나를 실행하고 방법과 결과별로 걸린 시간을 기록함.
+    """
+    started_at = time.perf_counter()
+    success = function(*args)
+    result = {True: 'success', False: 'failure', None: 'unavailable'}[success]
+    registry.observe('download_seconds', time.perf_counter() - started_at, method=method, result=result)
+    registry.inc('download_attempts_total', method=method, result=result)
+    return success
+
+  def __streamlink_session(self):
+    session = getattr(self.local, 'streamlink', None)
+    if session == None:
+      session = Streamlink()
+      if self.proxy != None:
+        session.set_option("http-proxy", self.proxy)
+      self.local.streamlink = session
+    return session
+
+  def streamlink_method(self, url: str, filename: str) -> bool:
+    if Streamlink == None:
+      return False
+    part_filename = f"{filename}{STREAMLINK_PART_EXTENSION}"
+    try:
+      with registry.timer('streamlink_resolve_seconds'):
+        streams = self.__streamlink_session().streams(url)
+      if 'best' not in streams:
+        return False
+      best = streams['best']
+      with self.__host_slot(getattr(best, 'url', url)):
+        with best.open() as stream:
+          with open(part_filename, 'wb') as f:
+            while True:
+              chunk = stream.read(CHUNK_SIZE)
+              if not chunk:
+                break
+              self.__received(len(chunk))
+              f.write(chunk)
+      os.replace(part_filename, filename)
+      return True
+    except Exception as e:
+      # print(f"streamlink_method failed | {e}", flush=True)
+      remove_file(part_filename)
+      return False
+
+  def subprocess_method(self, url: str, filename: str) -> bool:
+    part_filename = f"{filename}{STREAMLINK_PART_EXTENSION}"
+    try:
+      proxy_option = [] if self.proxy == None else ["--http-proxy", self.proxy]
+      commands = [sys.executable, "-m", "streamlink", "-o", part_filename, "--force"] + proxy_option + [url, "best"]
+      with registry.timer('streamlink_process_seconds'):
+        completed_process = subprocess.run(
+          commands,
+          capture_output=True
+        )
+      if completed_process.returncode != 0:
+        remove_file(part_filename)
+        return False
+      os.replace(part_filename, filename)
+      return True
+    except Exception as e:
+      # print(f"subprocess_method failed | {e}", flush=True)
+      remove_file(part_filename)
+      return False
+
+  def request_method(self, vod_url: str, filename: str):
+    """
+    vod_url을 직접 받음. `.part` 파일에 쓰고 다 받으면 이름을 바꿈.
+    이전에 받다 만 `.part` 파일이 있으면 Range 요청으로 나머지만 받음.
+
+    Returns:
+        True: 성공
+        False: 실패. 다시 시도하면 이어서 받음
+        None: vod_url로 받을 수 없는 클립 (다시 시도할 필요 없음)
+    """
+    if vod_url == None or len(vod_url) == 0:
+      return None
+    part_filename = f"{filename}{PART_EXTENSION}"
+    try:
+      offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+      headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+      with self.__host_slot(vod_url), self.session.get(vod_url, stream=True, headers=headers, timeout=30) as res:
+        if res.status_code == 416 and offset > 0:
+          if range_total(res) == offset:
+            # 이미 다 받은 파일
+            os.replace(part_filename, filename)
+            return True
+          # 전체 크기와 다른 `.part` 파일은 다음 시도에 처음부터 받음
+          remove_file(part_filename)
+          return False
+        if res.status_code in (400, 401, 403, 404, 410):
+          return None
+        if not res.ok:
+          return False
+        if res.status_code != 206:
+          # Range를 지원하지 않으면 처음부터 받음
+          offset = 0
+        expected_size = content_size(res, offset)
+        with open(part_filename, 'ab' if offset > 0 else 'wb') as f:
+          for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+            if chunk:
+              self.__received(len(chunk))
+              f.write(chunk)
+      if expected_size != None and os.path.getsize(part_filename) != expected_size:
+        return False
+      os.replace(part_filename, filename)
+      return True
+    except Exception as e:
+      # print(f"request_method failed | {e}", flush=True)
+      return False
+
+  def download(self, clip: dict, filename: str) -> str:
+    """
+    받는 데 성공한 방법('request', 'streamlink', 'subprocess')을 리턴함. 실패하면 None.
+    """
+    if self.gate == None:
+      return self.__download(clip, filename)
+    with self.gate:
+      return self.__download(clip, filename)
+
+  def __download(self, clip: dict, filename: str) -> str:
+    # 저장된 vod_url로 바로 받는 것을 먼저 시도함
+    for _ in range(2):
+      success = self.__attempt('request', self.request_method, clip.get('vod_url'), filename)
+      if success == True:
+        return 'request'
+      if success == None:
+        break
+      time.sleep(2)
+
+    # streamlink를 import할 수 없으면 바로 다음 방법을 사용함
+    for _ in range(2 if Streamlink != None else 0):
+      if self.__attempt('streamlink', self.streamlink_method, clip['url'], filename):
+        return 'streamlink'
+      time.sleep(2)
+
+    # 별도 프로세스로 받는 양은 bandwidthLimit에 포함되지 않음
+    print(f"\n[{datetime.now()}] Use streamlink process for {clip['created_at']}-{clip['url']}", flush=True)
+    if self.__attempt('subprocess', self.subprocess_method, clip['url'], filename):
+      return 'subprocess'
+    return None
+
+
+def content_size(res: requests.Response, offset: int):
+  """
+  다 받았을 때의 전체 파일 크기. 알 수 없으면 None.
+  """
+  if res.status_code == 206 and range_total(res) != None:
+    return range_total(res)
+  content_length = res.headers.get('Content-Length', '')
+  if content_length.isdigit() and res.headers.get('Content-Encoding', 'identity') == 'identity':
+    return offset + int(content_length)
+  return None
+
+
+def range_total(res: requests.Response):
+  """
+  Content-Range 헤더의 전체 크기 ('bytes 0-99/1000', 'bytes */1000'). 알 수 없으면 None.
+  """
+  content_range = res.headers.get('Content-Range', '')
+  if '/' not in content_range:
+    return None
+  total = content_range.rsplit('/', 1)[1]
+  return int(total) if total.isdigit() else None
+
+
+def remove_file(filename: str):
+  try:
+    os.remove(filename)
+  except OSError:
+    pass
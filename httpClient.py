@@ -0,0 +1,185 @@
+import random
+import threading
+import time
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import registry
+
+
+class TokenBucket:
+  """
+  thread-safe token bucket.
+  helix는 분당 800개(app access token 기준)의 요청을 허용하고
+  응답 헤더의 Ratelimit-Limit/Ratelimit-Remaining/Ratelimit-Reset으로
+  남은 양을 알려주므로 그 값을 따라서 bucket을 맞춤.
+  """
+  def __init__(self, capacity: int = 800, period: float = 60.0):
+    self.capacity = capacity
+    self.period = period
+    self.tokens = float(capacity)
+    self.reset_at = 0.0
+    self.blocked_until = 0.0
+    self.updated_at = time.monotonic()
+    self.lock = threading.Lock()
+
+  def __refill(self):
+    now = time.monotonic()
+    if self.reset_at > 0 and time.time() >= self.reset_at:
+      # 서버의 bucket이 다시 가득 찬 시점
+      self.tokens = float(self.capacity)
+      self.reset_at = 0.0
+    else:
+      self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.capacity / self.period)
+    self.updated_at = now
+
+  def acquire(self, amount: int = 1):
+    while True:
+      with self.lock:
+        wait = self.blocked_until - time.time()
+        if wait <= 0:
+          self.__refill()
+          if self.tokens >= amount:
+            self.tokens -= amount
+            return
+          wait = (amount - self.tokens) * self.period / self.capacity
+          if self.reset_at > 0:
+            wait = min(wait, self.reset_at - time.time())
+      time.sleep(max(wait, 0.01))
+
+  def update(self, limit: int, remaining: int, reset: float):
+    """
+    서버가 알려준 값으로 bucket을 맞춤.
+    서버 기준 남은 양보다 많이 가지고 있지 않도록 함.
+    """
+    with self.lock:
+      self.__refill()
+      if limit != None and limit > 0:
+        self.capacity = limit
+      if remaining != None:
+        self.tokens = min(self.tokens, remaining)
+      if reset != None and reset > time.time():
+        self.reset_at = reset
+
+  def wait_until_reset(self, reset: float):
+    """
+    429를 받은 경우 reset 시간까지 모든 요청이 기다리도록 함.
+    """
+    with self.lock:
+      self.tokens = 0.0
+      self.reset_at = reset
+      self.blocked_until = reset
+
+
+def int_header(headers, key: str):
+  try:
+    return int(headers[key])
+  except:
+    return None
+
+
+class HttpClient:
+  """
+  모든 api 요청이 거쳐가는 http 계층.
+  - 하나의 session(connection pool)을 여러 스레드가 공유함
+  - 응답 헤더의 rate limit을 따르는 token bucket
+  - 429, 5xx, 연결 오류는 backoff 후에 다시 시도
+  - 401은 refresh_credentials로 토큰을 새로 받은 후에 다시 시도
+  """
+  def __init__(self, proxy: str = None, retries: int = 5, backoff: float = 1.0, pool_size: int = 32, refresh_credentials=None):
+    self.retries = retries
+    self.backoff = backoff
+    self.refresh_credentials = refresh_credentials
+    self.authHeader = {}
+    self.auth_generation = 0
+    self.auth_lock = threading.Lock()
+    self.refresh_lock = threading.Lock()
+    self.bucket = TokenBucket()
+
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    self.session.mount("https://", adapter)
+    self.session.mount("http://", adapter)
+    if proxy != None:
+      self.session.proxies.update({
+        "http": proxy,
+        "https": proxy,
+      })
+
+  def set_auth_header(self, authHeader: dict):
+    with self.auth_lock:
+      self.authHeader = authHeader
+      self.auth_generation += 1
+
+  def __refresh(self, generation: int):
+    # 여러 스레드가 동시에 401을 받아도 토큰은 한 번만 새로 받음
+    with self.refresh_lock:
+      if generation != self.auth_generation or self.refresh_credentials == None:
+        return
+      self.refresh_credentials()
+
+  def __sleep_backoff(self, attempt: int):
+    time.sleep(self.backoff * (2 ** attempt) + random.uniform(0, self.backoff))
+
+  def request(self, method: str, url: str, headers: dict = None, authorize: bool = True, **kwargs) -> requests.Response:
+    last_error = None
+    for attempt in range(self.retries):
+      request_headers = dict(headers) if headers != None else {}
+      with self.auth_lock:
+        generation = self.auth_generation
+        if authorize:
+          request_headers.update(self.authHeader)
+
+      with registry.timer('api_rate_limit_wait_seconds'):
+        self.bucket.acquire()
+      started_at = time.perf_counter()
+      try:
+        res = self.session.request(method, url, headers=request_headers, **kwargs)
+      except requests.RequestException as e:
+        registry.inc('api_retries_total', reason='connection')
+        last_error = e
+        self.__sleep_backoff(attempt)
+        continue
+      registry.observe('api_request_seconds', time.perf_counter() - started_at, method=method, status=res.status_code)
+
+      self.bucket.update(
+        int_header(res.headers, 'Ratelimit-Limit'),
+        int_header(res.headers, 'Ratelimit-Remaining'),
+        int_header(res.headers, 'Ratelimit-Reset'),
+      )
+
+      if res.status_code == 429:
+        reset = int_header(res.headers, 'Ratelimit-Reset')
+        if reset == None:
+          retry_after = int_header(res.headers, 'Retry-After')
+          reset = time.time() + (retry_after if retry_after != None else self.backoff * (2 ** attempt))
+        self.bucket.wait_until_reset(reset)
+        registry.inc('api_retries_total', reason='429')
+        last_error = Exception(f"[{datetime.now()}] 429 Too Many Requests {url}")
+        continue
+      if res.status_code >= 500:
+        registry.inc('api_retries_total', reason='5xx')
+        last_error = Exception(f"[{datetime.now()}] {res.status_code} {url}")
+        self.__sleep_backoff(attempt)
+        continue
+      if res.status_code == 401 and authorize and self.refresh_credentials != None and attempt + 1 < self.retries:
+        registry.inc('api_retries_total', reason='401')
+        last_error = Exception(f"[{datetime.now()}] 401 Unauthorized {url}")
+        self.__refresh(generation)
+        continue
+      return res
+    raise Exception(last_error)
+
+  def get(self, url: str, headers: dict = None, authorize: bool = True) -> dict:
+    res = self.request("GET", url, headers=headers, authorize=authorize)
+    if not res.ok:
+      raise Exception(res.json())
+    return res.json()
+
+  def post(self, url: str, headers: dict = None, data=None, json=None, authorize: bool = True) -> dict:
+    res = self.request("POST", url, headers=headers, data=data, json=json, authorize=authorize)
+    if not res.ok:
+      raise Exception(res.json())
+    return res.json()
@@ -0,0 +1,93 @@
+import os
+import re
+
+
+# '[20171229-221223] title (AwkwardHel).mp4' -> ('20171229-221223', 'AwkwardHel', 'mp4')
+CLIP_FILENAME_PATTERN = re.compile(r'^\[(\d{8}-\d{6})\] .*\(([^()]*)\)\.(mp4|json)$')
+
+
+class Inventory:
+  """
+  다운로드 폴더에 이미 있는 클립 파일 목록.
+  파일마다 os.path.exists를 호출하는 대신 폴더를 os.scandir로 한 번만 훑어서 만듦.
+  네트워크 파일 시스템에서는 파일마다 왕복이 생기므로 훨씬 빠름.
+
+  파일 이름에 들어간 클립 id(앞 10글자)를 키로 하고
+  같은 id가 여러 개일 수 있으므로 만들어진 시간까지 비교함.
+  """
+  def __init__(self):
+    # clip_id -> [(timestamp, relative path without extension, size)]
+    self.videos = {}
+    # clip_id -> {(timestamp, relative path without extension)}
+    self.jsons = {}
+
+  def __len__(self):
+    return sum([len(videos) for videos in self.videos.values()])
+
+  def add(self, relative_directory: str, filename: str, size: int):
+    match = CLIP_FILENAME_PATTERN.match(filename)
+    if match == None:
+      return
+    (timestamp, clip_id, extension) = match.groups()
+    relative_path = os.path.join(relative_directory, filename[:-(len(extension) + 1)])
+    if extension == 'mp4':
+      self.videos.setdefault(clip_id, []).append((timestamp, relative_path, size))
+    else:
+      self.jsons.setdefault(clip_id, set()).add((timestamp, relative_path))
+
+  def find_video(self, relative_path: str):
+    """
+    relative_path(확장자 없음)와 같은 클립의 (relative path, size). 없으면 None.
+    제목이 바뀌어서 파일 이름이 달라도 id와 시간이 같으면 찾음.
+    """
+    match = CLIP_FILENAME_PATTERN.match(f"{os.path.basename(relative_path)}.mp4")
+    if match == None:
+      return None
+    (timestamp, clip_id, _) = match.groups()
+    candidates = [video for video in self.videos.get(clip_id, []) if video[0] == timestamp]
+    for (_, path, size) in candidates:
+      if path == relative_path:
+        return (path, size)
+    if len(candidates) == 1:
+      return (candidates[0][1], candidates[0][2])
+    return None
+
+  def has_video(self, relative_path: str) -> bool:
+    video = self.find_video(relative_path)
+    return video != None and video[1] > 0
+
+  def has_json(self, relative_path: str) -> bool:
+    match = CLIP_FILENAME_PATTERN.match(f"{os.path.basename(relative_path)}.json")
+    if match == None:
+      return False
+    (timestamp, clip_id, _) = match.groups()
+    return (timestamp, relative_path) in self.jsons.get(clip_id, set())
+
+
+def scan_streamer_directories(downloadDirectory: str, loginName: str) -> Inventory:
+  """
+  downloadDirectory 아래의 '<broadcaster_name> (<loginName>)' 폴더들을 훑음.
+  스트리머가 이름을 바꿔서 폴더가 여러 개여도 모두 포함함.
+  """
+  inventory = Inventory()
+  suffix = f"({loginName})"
+  try:
+    entries = list(os.scandir(downloadDirectory))
+  except FileNotFoundError:
+    return inventory
+
+  stack = [entry.name for entry in entries if entry.name.endswith(suffix) and entry.is_dir(follow_symlinks=False)]
+  while len(stack) > 0:
+    relative_directory = stack.pop()
+    try:
+      with os.scandir(os.path.join(downloadDirectory, relative_directory)) as iterator:
+        for entry in iterator:
+          if entry.is_dir(follow_symlinks=False):
+            stack.append(os.path.join(relative_directory, entry.name))
+          elif entry.name.endswith('.mp4'):
+            inventory.add(relative_directory, entry.name, entry.stat(follow_symlinks=False).st_size)
+          elif entry.name.endswith('.json'):
+            inventory.add(relative_directory, entry.name, 0)
+    except OSError as e:
+      print(f"scan error {relative_directory}: {e}")
+  return inventory
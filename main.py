@@ -4,13 +4,19 @@ import sys
 import traceback 
 import argparse
 
-from twitchApi import TwitchApi
+from twitchApi import TwitchApi, JSON_INDEX_DEPTHS
+from archiver import TwitchArchiver
+from database import DOWNLOAD_ORDERS
+from downloader import parse_byte_size
+from metrics import MetricsExporter
+import windowPlanner
 
 DIRPATH = os.path.dirname(os.path.realpath(__file__))
 CONFIGFILE = os.path.join(DIRPATH, "config.ini")
 DATABASEFILE = os.path.join(DIRPATH, "clips.sqlite3")
 
-twitchApi: TwitchApi = None
+twitchApi: TwitchApi | TwitchArchiver = None
+metricsExporter: MetricsExporter = None
 config = {}
 
 if os.path.exists(CONFIGFILE):
@@ -25,14 +31,45 @@ if os.path.exists(CONFIGFILE):
     print(e)
 
 
-def init_twitchApi(argDatabase, argClientId, argClientSecret, argStreamer, argReadSize, argProxy):
+def init_metrics(argMetricsFile=None, argMetricsInterval=None):
+  global config, metricsExporter
+  metricsFile = argMetricsFile if argMetricsFile != None else config.get('metricsFile', None)
+  metricsInterval = argMetricsInterval if argMetricsInterval != None else config.get('metricsInterval', 30)
+  if metricsFile == None or len(metricsFile) == 0:
+    return
+  try:
+    metricsInterval = float(metricsInterval)
+    if metricsInterval < 1:
+      metricsInterval = 1
+  except:
+    metricsInterval = 30
+  print(f'''
+    Metrics parameters
+      metricsFile       {os.path.realpath(metricsFile)}
+      metricsInterval   {metricsInterval}
+  ''')
+  # database writer보다 먼저 만들어서 프로그램이 끝날 때 마지막 commit까지 기록되도록 함
+  metricsExporter = MetricsExporter(metricsFile, metricsInterval)
+
+
+def init_twitchApi(argDatabase, argClientId, argClientSecret, argStreamer, argReadSize, argProxy, argTokenCache=None, argPrintIp=None, argStreamers=None, argUnifiedTable=None):
   global config, twitchApi
   databaseFile = argDatabase if argDatabase != None else DATABASEFILE
   clientId = argClientId if argClientId != None else config.get('clientId', None)
   clientSecret = argClientSecret if argClientSecret != None else config.get('clientSecret', None)
   streamerId = argStreamer if argStreamer != None else config.get('streamerId', None)
+  streamers = argStreamers if argStreamers != None else config.get('streamers', None)
+  if argStreamer != None and argStreamers == None:
+    # -s 옵션은 설정 파일의 streamers보다 우선함
+    streamers = None
   readSize = argReadSize if argReadSize != None else config.get('readSize', 40)
   proxy = argProxy if argProxy != None else config.get('proxy', None)
+  tokenCache = argTokenCache if argTokenCache != None else config.get('tokenCacheFile', None)
+  printIp = argPrintIp if argPrintIp != None else config.get('printIp', 'False')
+  printIp = (str(printIp).lower() == 'true')
+  unifiedTable = argUnifiedTable if argUnifiedTable != None else config.get('unifiedTable', None)
+  # 주어지지 않으면 database에 통합 테이블이 있는지에 따라서 정함
+  unifiedTable = (str(unifiedTable).lower() == 'true') if unifiedTable != None else None
   
   try:
     readSize = int(readSize)
@@ -47,31 +84,48 @@ def init_twitchApi(argDatabase, argClientId, argClientSecret, argStreamer, argRe
     raise Exception("database file path is not valid")
   if proxy != None and len(proxy) == 0:
     proxy = None
+  if tokenCache != None and len(tokenCache) == 0:
+    tokenCache = None
   if clientId == None or len(clientId) == 0:
     raise Exception("client_id is needed")
   if clientSecret == None or len(clientSecret) == 0:
     raise Exception("clientSecret is needed")
-  if streamerId == None or len(streamerId) == 0:
+  streamerIds = [streamer.strip() for streamer in streamers.split(',') if len(streamer.strip()) > 0] if streamers != None else []
+  if len(streamerIds) == 0 and streamerId != None and len(streamerId) != 0:
+    streamerIds = [streamerId]
+  if len(streamerIds) == 0:
     raise Exception("streamer_id is needed")
   print(f'''
     Init parameters
       databaseFile  {os.path.realpath(databaseFile)}
       clientId      HIDDEN
       clientSecret  HIDDEN
-      streamerId    {streamerId}
+      streamers     {', '.join(streamerIds)}
       readSize      {readSize}
       proxy         {'HIDDEN' if proxy != None else 'NOT SET'}
+      tokenCache    {os.path.realpath(tokenCache) if tokenCache != None else 'NEXT TO DATABASE'}
+      printIp       {printIp}
+      unifiedTable  {unifiedTable if unifiedTable != None else 'AUTO'}
   ''')
-  twitchApi = TwitchApi(databaseFile, clientId, clientSecret, streamerId, readSize, proxy)
+  if len(streamerIds) == 1:
+    twitchApi = TwitchApi(databaseFile, clientId, clientSecret, streamerIds[0], readSize, proxy, tokenCache, printIp, unifiedTable)
+  else:
+    # 토큰, http client, database writer, 다운로드 스레드 풀을 같이 사용함
+    twitchApi = TwitchArchiver(databaseFile, clientId, clientSecret, streamerIds, readSize, proxy, tokenCache, printIp, unifiedTable)
 
 
-def write_json(argDownloadDirectory, argConcurrency):
+def write_json(argDownloadDirectory, argConcurrency, argJsonIndex=None):
   global twitchApi
   try:
     downloadDirectory = argDownloadDirectory if argDownloadDirectory != None else config.get('downloadDirectory', None)
     concurrency = argConcurrency if argConcurrency != None else config.get('concurrency', 6)
+    jsonIndex = argJsonIndex if argJsonIndex != None else config.get('jsonIndex', None)
     if downloadDirectory == None:
       raise Exception(f"download directory is not specified!")
+    if jsonIndex != None and len(jsonIndex) == 0:
+      jsonIndex = None
+    if jsonIndex != None and jsonIndex not in JSON_INDEX_DEPTHS:
+      raise Exception(f"json index should be one of {list(JSON_INDEX_DEPTHS.keys())}")
     try:
       concurrency = int(argConcurrency)
     except:
@@ -84,24 +138,43 @@ def write_json(argDownloadDirectory, argConcurrency):
     write_json parameters
       downloadDirectory   {os.path.realpath(downloadDirectory)}
       concurrency         {concurrency}
+      jsonIndex           {jsonIndex if jsonIndex != None else 'NOT SET'}
     ''')
-    twitchApi.write_json_from_database(downloadDirectory, concurrency)
+    twitchApi.write_json_from_database(downloadDirectory, concurrency, jsonIndex)
   except Exception as e:
     traceback.print_exception(e)
     sys.exit(1)
   sys.exit(0)
 
 
-def make_database(argFromDatabaseDate=False):
+def make_database(argFromDatabaseDate=False, argCrawlWorkers=None, argRefresh=False, argRefreshTiers=None):
   global twitchApi
   try:
     fromDatabaseDate = argFromDatabaseDate if argFromDatabaseDate != None else config.get('fromDatabaseDate', False)
+    crawlWorkers = argCrawlWorkers if argCrawlWorkers != None else config.get('crawlWorkers', 1)
+    refreshTiers = argRefreshTiers if argRefreshTiers != None else config.get('refreshTiers', windowPlanner.DEFAULT_REFRESH_TIERS)
+    if refreshTiers == None or len(refreshTiers) == 0:
+      refreshTiers = windowPlanner.DEFAULT_REFRESH_TIERS
+    
+    try:
+      crawlWorkers = int(crawlWorkers)
+    except:
+      crawlWorkers = 1
+    if crawlWorkers < 1:
+      crawlWorkers = 1
     
     print(f'''
     Read clips parameters
       fromDatabaseDate   {fromDatabaseDate}
+      crawlWorkers       {crawlWorkers}
+      refresh            {argRefresh}
+      refreshTiers       {refreshTiers if argRefresh == True else 'NOT USED'}
     ''')
-    twitchApi.read_all_clips((fromDatabaseDate == True))
+    twitchApi.read_all_clips(
+      (fromDatabaseDate == True), 
+      crawlWorkers, 
+      windowPlanner.parse_refresh_tiers(refreshTiers) if argRefresh == True else None
+    )
   except Exception as e:
     traceback.print_exception(e)
     sys.exit(1)
@@ -114,7 +187,11 @@ def download_clips_from_database(
     argForceDownload, 
     argSkipDownloadIfExists,
     argMinView, 
-    argMaxClips
+    argMaxClips,
+    argOrder=None,
+    argBandwidthLimit=None,
+    argHostConnections=None,
+    argAutoTune=None
   ):
   global config, twitchApi
   try:
@@ -124,6 +201,11 @@ def download_clips_from_database(
     skipDownloadIfExists = argSkipDownloadIfExists if argSkipDownloadIfExists != None else config.get('skipDownloadIfExists', False)
     minView = argMinView if argMinView != None else config.get('minView', -1)
     maxClips = argMaxClips if argMaxClips != None else config.get('maxClips', -1)
+    order = argOrder if argOrder != None else config.get('downloadOrder', 'rowid')
+    bandwidthLimit = argBandwidthLimit if argBandwidthLimit != None else config.get('bandwidthLimit', '0')
+    hostConnections = argHostConnections if argHostConnections != None else config.get('hostConnections', 0)
+    autoTune = argAutoTune if argAutoTune != None else config.get('autoTune', 'False')
+    autoTune = (str(autoTune).lower() == 'true')
     concurrency = argConcurrency if argConcurrency != None else config.get('concurrency', 6)
     
     if downloadDirectory == None:
@@ -151,6 +233,25 @@ def download_clips_from_database(
     if maxClips <= 0:
       maxClips = -1
     
+    try:
+      bandwidthLimit = parse_byte_size(bandwidthLimit)
+    except:
+      raise Exception(f"bandwidth limit is not valid: {bandwidthLimit}")
+    
+    try:
+      hostConnections = max(0, int(hostConnections))
+    except:
+      hostConnections = 0
+    
+    if autoTune and bandwidthLimit == 0:
+      print("autoTune needs bandwidthLimit as the target rate. autoTune is disabled")
+      autoTune = False
+    
+    if order == None or len(order) == 0:
+      order = 'rowid'
+    if order not in DOWNLOAD_ORDERS:
+      raise Exception(f"download order should be one of {list(DOWNLOAD_ORDERS.keys())}")
+    
     print(f'''
     Download parameters
       downloadDirectory   {os.path.realpath(downloadDirectory)}
@@ -158,7 +259,11 @@ def download_clips_from_database(
       forceDownload       {forceDownload}
       minView             {minView}
       maxClips            {maxClips}
+      order               {order}
       concurrency         {concurrency}
+      bandwidthLimit      {f'{bandwidthLimit} bytes/s' if bandwidthLimit > 0 else 'NOT SET'}
+      hostConnections     {hostConnections if hostConnections > 0 else 'NOT SET'}
+      autoTune            {autoTune}
     ''')
     twitchApi.download_clips_from_database(
       downloadDirectory, 
@@ -167,13 +272,88 @@ def download_clips_from_database(
       forceDownload,
       skipDownloadIfExists,
       minView, 
-      maxClips
+      maxClips,
+      order,
+      bandwidthLimit,
+      hostConnections,
+      autoTune
     )
   except Exception as e:
     traceback.print_exception(e)
     sys.exit(1)
 
 
+def verify_clips(argDownloadDirectory, argWorkers=None):
+  global config, twitchApi
+  try:
+    downloadDirectory = argDownloadDirectory if argDownloadDirectory != None else config.get('downloadDirectory', None)
+    workers = argWorkers if argWorkers != None else config.get('verifyWorkers', 0)
+    
+    if downloadDirectory == None:
+      raise Exception(f"download directory is not specified!")
+    
+    try:
+      workers = int(workers)
+    except:
+      workers = 0
+    if workers <= 0:
+      workers = os.cpu_count() or 1
+    
+    print(f'''
+    Verify parameters
+      downloadDirectory   {os.path.realpath(downloadDirectory)}
+      workers             {workers}
+    ''')
+    twitchApi.verify_downloads(downloadDirectory, workers)
+  except Exception as e:
+    traceback.print_exception(e)
+    sys.exit(1)
+
+
+def watch_clips(argDownloadDirectory, argConcurrency, argSaveJson, argMinView, argMinInterval=None, argMaxInterval=None):
+  global config, twitchApi
+  try:
+    downloadDirectory = argDownloadDirectory if argDownloadDirectory != None else config.get('downloadDirectory', None)
+    saveJson = argSaveJson if argSaveJson != None else config.get('saveJson', False)
+    saveJson = (str(saveJson).lower() == 'true')
+    minView = argMinView if argMinView != None else config.get('minView', -1)
+    concurrency = argConcurrency if argConcurrency != None else config.get('concurrency', 6)
+    minInterval = argMinInterval if argMinInterval != None else config.get('watchMinInterval', 15)
+    maxInterval = argMaxInterval if argMaxInterval != None else config.get('watchMaxInterval', 120)
+    
+    if downloadDirectory == None:
+      raise Exception(f"download directory is not specified!")
+    
+    try:
+      concurrency = max(1, int(concurrency))
+    except:
+      concurrency = 6
+    
+    try:
+      minView = max(0, int(minView))
+    except:
+      minView = 0
+    
+    try:
+      minInterval = max(1, float(minInterval))
+      maxInterval = max(minInterval, float(maxInterval))
+    except:
+      raise Exception(f"watch interval is not valid: {minInterval}, {maxInterval}")
+    
+    print(f'''
+    Watch parameters
+      downloadDirectory   {os.path.realpath(downloadDirectory)}
+      saveJson            {saveJson}
+      minView             {minView}
+      concurrency         {concurrency}
+      interval            {minInterval}s ~ {maxInterval}s
+    ''')
+    twitchApi.watch(downloadDirectory, concurrency, saveJson, minView, minInterval, maxInterval)
+  except Exception as e:
+    traceback.print_exception(e)
+    sys.exit(1)
+
+
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(
     prog="Twitch Clip Archiver",
@@ -183,33 +363,71 @@ if __name__ == "__main__":
   
   parser.add_argument("-n", "--skip-build-database", action="store_true", help="use existing database without requesting from server")
   parser.add_argument("-d", "--download", action="store_true", help="download all clips in database")
+  parser.add_argument("-w", "--watch", action="store_true", help="keep running and poll only the latest hour of clips, downloading new clips as soon as they are found. runs after the other steps")
   parser.add_argument("-j", "--save-json", action="store_true", help="save clip information as json file")
   parser.add_argument("-f", "--force-download", action="store_true", help="re-download file if marked as downloaded")
   parser.add_argument("-z", "--from-database-date", action="store_true", help="read clips from twitch in range from the latest month in database")
+  parser.add_argument("-r", "--refresh", action="store_true", help="refresh view counts only for windows that are due by refresh tiers")
   parser.add_argument("-e", "--skip-download-if-exists", action="store_true", help="do not download clips if exists on file system.")
+  parser.add_argument("--verify", action="store_true", help="check downloaded mp4 files by their box headers and recorded sizes, and mark broken clips as not downloaded. runs before downloading")
   
   parser.add_argument("--json-only", action="store_true", help="update json file from database information. Use with download_directory option")
+  parser.add_argument("--json-index", choices=list(JSON_INDEX_DEPTHS.keys()), help="with --json-only, write one index file per day or month folder instead of a json file per clip")
   
   parser.add_argument("--client-id", help="twitch client id")
   parser.add_argument("--client-secret", help="twitch client secret")
   
   parser.add_argument("-b", "--database", help="database path")
   parser.add_argument("-s", "--streamer", help="streamer loginName(not nickname!!!) or broadcaster_id(number string)")
+  parser.add_argument("--streamers", help="comma separated streamers to archive in one process. they share the token, rate limit and download pool")
   parser.add_argument("-o", "--download-directory", help="path to save clips")
   parser.add_argument("-m", "--min-view", help="minimum view count to download (default=0)")
   parser.add_argument("-M", "--max-clips", help="maximun number of clips to download. -1 is infinite. (default=-1)")
+  parser.add_argument("--order", choices=list(DOWNLOAD_ORDERS.keys()), help="download order. views: most viewed first, newest, oldest, score: views with a penalty for age. (default=rowid)")
+  parser.add_argument("--bandwidth-limit", help="total download speed limit in bytes per second. K, M, G units are allowed. e.g. 10M (default=no limit)")
+  parser.add_argument("--host-connections", help="maximum concurrent downloads from the same host. (default=no limit)")
+  parser.add_argument("--auto-tune", action="store_true", default=None, help="adjust active download workers to keep the speed near --bandwidth-limit")
   parser.add_argument("--read-size", help="the number of clips fetch from twitch server. (default=40)")
   parser.add_argument("--concurrency", help="download concurrency. (default=6)")
+  parser.add_argument("--verify-workers", help="the number of processes checking files with --verify. (default=cpu count)")
+  parser.add_argument("--watch-min-interval", help="minimum seconds between polls in watch mode. used while new clips are frequent. (default=15)")
+  parser.add_argument("--watch-max-interval", help="maximum seconds between polls in watch mode. used while there are no new clips. (default=120)")
+  parser.add_argument("--refresh-tiers", help=f"'<max age days>:<interval days>,...' used with --refresh. (default={windowPlanner.DEFAULT_REFRESH_TIERS})")
+  parser.add_argument("--crawl-workers", help="the number of date windows requested at once while reading clips. (default=1)")
   parser.add_argument("--proxy", help="proxy url")
+  parser.add_argument("--token-cache", help="path to cache the twitch access token. (default=<database>.token.json)")
+  parser.add_argument("--print-ip", action="store_true", default=None, help="print public ip address before start")
+  parser.add_argument("--unified-table", action="store_true", default=None, help="store clips of all streamers in one 'clips' table keyed by broadcaster_id. used automatically if the database already has it. convert an existing database with 'migrate.py --unify'")
+  parser.add_argument("--metrics-file", help="write per-stage metrics to this file periodically. json if it ends with .json, otherwise prometheus textfile format")
+  parser.add_argument("--metrics-interval", help="seconds between metrics file updates. (default=30)")
   
   args = parser.parse_args() 
   
-  init_twitchApi(args.database, args.client_id, args.client_secret, args.streamer, args.read_size, args.proxy)
+  init_metrics(
+    args.metrics_file,
+    args.metrics_interval,
+  )
+  
+  init_twitchApi(
+    args.database, 
+    args.client_id, 
+    args.client_secret, 
+    args.streamer, 
+    args.read_size, 
+    args.proxy, 
+    args.token_cache, 
+    args.print_ip,
+    args.streamers,
+    args.unified_table,
+  )
   
   if args.skip_build_database != True:
     print(f"Read clips from twitch server...")
     make_database(
-      (args.from_database_date == True)
+      (args.from_database_date == True),
+      args.crawl_workers,
+      (args.refresh == True),
+      args.refresh_tiers,
     )
   
   if args.json_only == True:
@@ -218,8 +436,16 @@ if __name__ == "__main__":
     write_json(
       args.download_directory,
       args.concurrency,
+      args.json_index,
     )
     
+  if args.verify == True:
+    print(f"Verify downloaded clips...")
+    verify_clips(
+      args.download_directory,
+      args.verify_workers,
+    )
+  
   if args.download == True:
     print(f"Download clips...")
     download_clips_from_database(
@@ -230,5 +456,19 @@ if __name__ == "__main__":
       (args.skip_download_if_exists == True),
       args.min_view,
       args.max_clips,
+      args.order,
+      args.bandwidth_limit,
+      args.host_connections,
+      args.auto_tune,
     )
   
+  if args.watch == True:
+    print(f"Watch new clips...")
+    watch_clips(
+      args.download_directory,
+      args.concurrency,
+      True if args.save_json == True else None,
+      args.min_view,
+      args.watch_min_interval,
+      args.watch_max_interval,
+    )
@@ -0,0 +1,153 @@
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+PREFIX = 'clip_archiver_'
+# 초 단위 latency histogram의 구간
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, float('inf'))
+
+
+class Histogram:
+  def __init__(self):
+    self.counts = [0] * len(BUCKETS)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value: float):
+    self.count += 1
+    self.sum += value
+    for i, bound in enumerate(BUCKETS):
+      if value <= bound:
+        self.counts[i] += 1
+        break
+
+
+class MetricsRegistry:
+  """
+  단계별 counter와 latency histogram을 모아둠. 여러 스레드에서 호출해도 됨.
+  metric은 (이름, label 목록)으로 구분함.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.histograms = {}
+    self.started_at = time.time()
+
+  def inc(self, name: str, value: float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def observe(self, name: str, seconds: float, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      if key not in self.histograms:
+        self.histograms[key] = Histogram()
+      self.histograms[key].observe(seconds)
+
+  @contextmanager
+  def timer(self, name: str, **labels):
+    started_at = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - started_at, **labels)
+
+  def to_prometheus(self) -> str:
+    def label_text(labels, extra=()):
+      items = list(labels) + list(extra)
+      if len(items) == 0:
+        return ''
+      return '{' + ','.join([f'{key}="{str(value)}"' for (key, value) in items]) + '}'
+
+    lines = []
+    with self.lock:
+      typed = set()
+      for ((name, labels), value) in sorted(self.counters.items()):
+        if name not in typed:
+          lines.append(f"# TYPE {PREFIX}{name} counter")
+          typed.add(name)
+        lines.append(f"{PREFIX}{name}{label_text(labels)} {value}")
+      for ((name, labels), histogram) in sorted(self.histograms.items(), key=lambda item: item[0]):
+        if name not in typed:
+          lines.append(f"# TYPE {PREFIX}{name} histogram")
+          typed.add(name)
+        cumulative = 0
+        for (bound, count) in zip(BUCKETS, histogram.counts):
+          cumulative += count
+          le = '+Inf' if bound == float('inf') else str(bound)
+          lines.append(f"{PREFIX}{name}_bucket{label_text(labels, [('le', le)])} {cumulative}")
+        lines.append(f"{PREFIX}{name}_sum{label_text(labels)} {histogram.sum}")
+        lines.append(f"{PREFIX}{name}_count{label_text(labels)} {histogram.count}")
+    lines.append(f"{PREFIX}uptime_seconds {time.time() - self.started_at}")
+    return '\n'.join(lines) + '\n'
+
+  def to_dict(self) -> dict:
+    def key_text(name, labels):
+      if len(labels) == 0:
+        return name
+      return name + '{' + ','.join([f'{key}={value}' for (key, value) in labels]) + '}'
+
+    with self.lock:
+      return {
+        'uptime_seconds': time.time() - self.started_at,
+        'counters': {key_text(name, labels): value for ((name, labels), value) in self.counters.items()},
+        'histograms': {
+          key_text(name, labels): {
+            'count': histogram.count,
+            'sum': histogram.sum,
+            'avg': histogram.sum / histogram.count if histogram.count > 0 else 0,
+            'buckets': {
+              ('+Inf' if bound == float('inf') else str(bound)): count
+              for (bound, count) in zip(BUCKETS, histogram.counts)
+            },
+          }
+          for ((name, labels), histogram) in self.histograms.items()
+        },
+      }
+
+
+registry = MetricsRegistry()
+
+
+class MetricsExporter:
+  """
+  registry를 interval 초마다, 그리고 프로그램이 끝날 때 파일로 씀.
+  확장자가 .json이면 json으로, 아니면 prometheus textfile 형식으로 씀.
+  node_exporter가 쓰는 도중의 파일을 읽지 않도록 임시 파일에 쓰고 이름을 바꿈.
+  """
+  def __init__(self, path: str, interval: float = 30.0, registry: MetricsRegistry = registry):
+    self.path = path
+    self.interval = interval
+    self.registry = registry
+    self.stop_event = threading.Event()
+    self.thread = threading.Thread(target=self.__run, name="MetricsExporter", daemon=True)
+    self.thread.start()
+    atexit.register(self.close)
+
+  def write(self):
+    try:
+      if self.path.endswith('.json'):
+        content = json.dumps(self.registry.to_dict(), indent=2)
+      else:
+        content = self.registry.to_prometheus()
+      temp_path = f"{self.path}.tmp"
+      with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+      os.replace(temp_path, self.path)
+    except Exception as e:
+      print(f"metrics write error {e}. not critical...")
+
+  def __run(self):
+    while not self.stop_event.wait(self.interval):
+      self.write()
+
+  def close(self):
+    if self.stop_event.is_set():
+      return
+    self.stop_event.set()
+    self.write()
@@ -2,73 +2,192 @@ import argparse
 import sqlite3
 from datetime import datetime
 
+from tqdm import tqdm
 
 
-def migrate(database_path):
-  def table_names(cursor: sqlite3.Cursor):
-    cursor.execute('''
-      SELECT 
-          name
-      FROM 
-          sqlite_schema
-      WHERE 
-          type ='table' AND 
-          name NOT LIKE 'sqlite_%';
-    ''')
-    tables = cursor.fetchall()
-    tables = [i[0] for i in tables]
-    return tables 
-  
-  connection = sqlite3.connect(database_path)
-  cursor = connection.cursor()
-  cursor2 = connection.cursor()
-  
-  tables = table_names(cursor)
-  for table in tables:
-
-    # update table 
-    try:
-      cursor.execute(f'ALTER TABLE {table} ADD COLUMN vod_url TEXT;')
-    except Exception as e:
-      print(f'vod_url creation error: {e}')
-    try:
-      cursor.execute(f'ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP;')
-    except Exception as e:
-      print(f'updated_at creation error: {e}')
-
-    
-    try:
-      # update vod_url, updated_at column 
-      cursor.execute(f'SELECT _id, thumbnail_url FROM {table}')
-      for clip in cursor:
-        _id, thumbnail_url = clip 
-        vod_url = thumbnail_url[:thumbnail_url.index('-preview-')] + '.mp4'
-        updated_at = datetime.now() 
-        cursor2.execute(f'''
-        UPDATE {table} SET vod_url=?, updated_at=? WHERE _id=?;
-        ''', (vod_url, updated_at, _id))
-        
-    except Exception as e:
-      print(f'UPDATE CLIPS ERROR: {e}')
-  
+# 한 번에 갱신하는 행 수. 갱신할 때마다 commit해서 쓰기 lock을 오래 잡지 않음
+CHUNK_SIZE = 10000
+
+
+def add_columns(columns: list):
+  """
+  없는 열만 추가하는 migration 단계
+  """
+  def step(connection: sqlite3.Connection, table: str):
+    existing = [row[1] for row in connection.execute(f"PRAGMA table_info({table})").fetchall()]
+    for (column, definition) in columns:
+      if column not in existing:
+        connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    connection.commit()
+  return step
+
+
+def backfill_vod_url(connection: sqlite3.Connection, table: str):
+  """
+  thumbnail_url로 vod_url을 채움.
+  'https://.../AT-cm%7C123-preview-480x272.jpg' -> 'https://.../AT-cm%7C123.mp4'
+
+  python에서 행마다 UPDATE하는 대신 _id 구간마다 UPDATE 한 번으로 처리하고 구간마다 commit함.
+  중간에 멈춰도 vod_url이 비어있는 행만 갱신하므로 다시 실행하면 이어서 처리함.
+  """
+  (low, high) = connection.execute(f'''
+  SELECT min(_id), max(_id) FROM {table} WHERE vod_url IS NULL OR vod_url = ''
+  ''').fetchone()
+  if low == None:
+    return
+  updated_at = datetime.now()
+  with tqdm(total=high - low + 1, unit='row', desc=f"{table} vod_url") as progress_bar:
+    for started_at in range(low, high + 1, CHUNK_SIZE):
+      connection.execute(f'''
+      UPDATE {table} SET
+        vod_url = substr(thumbnail_url, 1, instr(thumbnail_url, '-preview-') - 1) || '.mp4',
+        updated_at = COALESCE(updated_at, ?)
+      WHERE _id >= ? AND _id < ? AND (vod_url IS NULL OR vod_url = '') AND instr(thumbnail_url, '-preview-') > 0
+      ''', (updated_at, started_at, started_at + CHUNK_SIZE))
+      connection.commit()
+      progress_bar.update(min(CHUNK_SIZE, high + 1 - started_at))
+
+
+# (버전, 설명, 단계). 버전 순서대로 한 번씩만 실행됨.
+# 새 열을 추가할 때는 database.py의 CREATE TABLE과 여기에 같이 추가함
+MIGRATIONS = [
+  (1, "add vod_url, updated_at columns", add_columns([('vod_url', 'TEXT'), ('updated_at', 'TIMESTAMP')])),
+  (2, "fill vod_url from thumbnail_url", backfill_vod_url),
+  (3, "add relative_path column", add_columns([('relative_path', 'TEXT DEFAULT ""')])),
+  (4, "add json_hash column", add_columns([('json_hash', 'TEXT DEFAULT ""')])),
+  (5, "add file_size column", add_columns([('file_size', 'INTEGER DEFAULT -1')])),
+  (6, "add download_method column", add_columns([('download_method', 'TEXT DEFAULT ""')])),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def create_version_table(connection: sqlite3.Connection):
+  connection.execute('''
+CREATE TABLE IF NOT EXISTS schema_version (
+  table_name TEXT PRIMARY KEY,
+  version INTEGER,
+  updated_at TIMESTAMP
+);
+''')
+  connection.commit()
+
+
+def get_version(connection: sqlite3.Connection, table: str) -> int:
+  row = connection.execute("SELECT version FROM schema_version WHERE table_name=?", (table, )).fetchone()
+  return row[0] if row != None else 0
+
+
+def set_version(connection: sqlite3.Connection, table: str, version: int):
+  connection.execute('''
+  INSERT INTO schema_version(table_name, version, updated_at) VALUES (?,?,?)
+  ON CONFLICT (table_name) DO UPDATE SET version=excluded.version, updated_at=excluded.updated_at
+  ''', (table, version, datetime.now()))
   connection.commit()
-  cursor.close()
-  cursor2.close()
+
+
+def apply_migrations(connection: sqlite3.Connection, table: str) -> int:
+  """
+  table에 아직 적용되지 않은 migration을 순서대로 적용하고 적용한 수를 리턴함.
+  단계가 끝날 때마다 버전을 기록하므로 중간에 멈춰도 끝난 단계는 다시 실행하지 않음.
+  """
+  create_version_table(connection)
+  current_version = get_version(connection, table)
+  pending = [migration for migration in MIGRATIONS if migration[0] > current_version]
+  for (version, description, step) in pending:
+    print(f"[{table}] migration {version}: {description}")
+    step(connection, table)
+    set_version(connection, table, version)
+  return len(pending)
+
+
+def table_names(connection: sqlite3.Connection) -> list:
+  rows = connection.execute('''
+    SELECT
+        name
+    FROM
+        sqlite_master
+    WHERE
+        type ='table' AND
+        name LIKE 'clips\\_%' ESCAPE '\\';
+  ''').fetchall()
+  return [row[0] for row in rows]
+
+
+def migrate(database_path):
+  # database.py가 이 모듈을 사용하므로 순환 import를 피하기 위해서 여기서 import함
+  from database import ClipDatabase, UNIFIED_TABLE, clip_index_queries
+
+  database = ClipDatabase(database_path, unified=False)
+  # create_table이 밀린 migration과 인덱스를 적용함
+  for table in table_names(database.connection):
+    database.create_table(table[len('clips_'):])
+  if database.table_exists(UNIFIED_TABLE):
+    apply_migrations(database.connection, UNIFIED_TABLE)
+    for query in clip_index_queries(UNIFIED_TABLE, 'broadcaster_id'):
+      database.connection.execute(query)
+    database.connection.commit()
+  database.close()
+
+
+def unify(database_path, dropOldTables: bool = False):
+  """
+  스트리머마다 있는 `clips_<loginName>` 테이블을 하나의 `clips` 테이블로 옮김.
+  _id 구간마다 INSERT ... SELECT 한 번으로 옮기고 commit함.
+  이미 옮긴 클립(같은 id)은 무시하므로 중간에 멈춰도 다시 실행하면 됨.
+  """
+  from database import ClipDatabase, UNIFIED_TABLE
+
+  database = ClipDatabase(database_path, unified=True)
+  connection = database.connection
+  for table in table_names(connection):
+    loginName = table[len('clips_'):]
+    apply_migrations(connection, table)
+    row = connection.execute(f"SELECT broadcaster_id FROM {table} WHERE broadcaster_id IS NOT NULL LIMIT 1").fetchone()
+    if row == None:
+      print(f"[{table}] no clips. skipped")
+      continue
+    broadcasterId = row[0]
+    if database.get_user(loginName=loginName) == None:
+      database.save_user(broadcasterId, loginName)
+    database.create_table(loginName, broadcasterId)
+
+    columns = ', '.join([row[1] for row in connection.execute(f"PRAGMA table_info({table})").fetchall() if row[1] != '_id'])
+    (low, high) = connection.execute(f"SELECT min(_id), max(_id) FROM {table}").fetchone()
+    with tqdm(total=high - low + 1, unit='row', desc=f"{table} -> {UNIFIED_TABLE}") as progress_bar:
+      for started_at in range(low, high + 1, CHUNK_SIZE):
+        connection.execute(f'''
+        INSERT OR IGNORE INTO {UNIFIED_TABLE}({columns}) 
+        SELECT {columns} FROM {table} WHERE _id >= ? AND _id < ? ORDER BY _id
+        ''', (started_at, started_at + CHUNK_SIZE))
+        connection.commit()
+        progress_bar.update(min(CHUNK_SIZE, high + 1 - started_at))
+
+    if dropOldTables:
+      connection.execute(f"DROP TABLE {table}")
+      connection.execute("DELETE FROM schema_version WHERE table_name=?", (table, ))
+      connection.commit()
+  database.close()
 
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(
     prog="Twitch Clip Archiver DB Migrator",
-    description="Add vod_url, updated_at columns to given database",
+    description="Apply pending schema migrations and secondary indexes to given database. main.py also applies them on startup",
   )
-  
+
   parser.add_argument('databases', type=str, nargs='+',
                       help='databases to migrate')
-  
-  databases = parser.parse_args().databases 
-  
-  for database in databases:
-    migrate(database)
+  parser.add_argument('--unify', action='store_true',
+                      help="copy clips_<loginName> tables into one 'clips' table keyed by broadcaster_id. main.py uses it automatically afterwards")
+  parser.add_argument('--drop-old-tables', action='store_true',
+                      help="with --unify, drop clips_<loginName> tables after copying")
+
+  args = parser.parse_args()
+
+  for database in args.databases:
+    if args.unify:
+      unify(database, args.drop_old_tables)
+    else:
+      migrate(database)
     print(f'{database} DONE!')
-  
-  
\ No newline at end of file
+
@@ -0,0 +1,38 @@
+import unittest
+from datetime import datetime
+
+import windowPlanner
+
+
+class PlanWindowsTest(unittest.TestCase):
+  def crawl(self, planned: list, clips_per_month: int) -> list:
+    """
+    planned 구간을 조회했을 때 기록되는 (started_at, ended_at, clip_count) 목록.
+    클립은 달마다 clips_per_month 개씩 고르게 있다고 봄.
+    """
+    months = [
+      (started_at, ended_at, clips_per_month)
+      for (started_at, ended_at) in windowPlanner.month_windows(2020, 1, datetime(2020, 12, 1))
+    ]
+    return [(started_at, ended_at, windowPlanner.known_density((started_at, ended_at), months)) for (started_at, ended_at) in planned]
+
+  def test_plan_is_stable_over_its_own_records(self):
+    windows = windowPlanner.month_windows(2020, 1, datetime(2020, 12, 1))
+    records = self.crawl(windows, 60)
+    plans = []
+    for _ in range(4):
+      planned = windowPlanner.plan_windows(windows, records)
+      plans.append(planned)
+      records = self.crawl(planned, 60)
+    self.assertLess(len(plans[0]), len(windows))
+    for planned in plans[1:]:
+      self.assertEqual(plans[0], planned)
+
+  def test_merged_record_is_shared_by_its_months(self):
+    records = [(datetime(2020, 1, 1), datetime(2020, 3, 1), 120)]
+    self.assertEqual(windowPlanner.known_density((datetime(2020, 1, 1), datetime(2020, 2, 1)), records), 62)
+    self.assertEqual(windowPlanner.known_density((datetime(2020, 1, 1), datetime(2020, 4, 1)), records), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
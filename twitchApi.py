@@ -1,80 +1,138 @@
 import os 
-import sys
-import requests 
 import json
+import hashlib
 import time
-from datetime import datetime, timezone
-import subprocess
+from datetime import datetime, timedelta, timezone
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
 
 from database import ClipDatabase
+from httpClient import HttpClient
+from downloader import DownloadEngine, PART_EXTENSION
+from inventory import scan_streamer_directories
+from metrics import registry
+import verifier
+import watcher
+import windowPlanner
 
 
+# 파일 이름에 쓸 수 없는 문자를 한 번에 바꾸기 위한 표
+INVALID_FILENAME_TABLE = str.maketrans({
+  ':': '%3A',
+  '/': '%2F',
+  '\\': '%5C',
+  '*': '%2A',
+  '?': '%3F',
+  '"': "%22",
+  '<': '%3C',
+  '>': '%3E',
+  '|': '%7C',
+  '\n': '',
+  '\r': '',
+})
+
 def replace_invalid_filename(source):
-    replace_list = {
-      ':': '%3A',
-      '/': '%2F',
-      '\\': '%5C',
-      '*': '%2A',
-      '?': '%3F',
-      '"': "%22",
-      '<': '%3C',
-      '>': '%3E',
-      '|': '%7C',
-      '\n': '',
-      '\r': '',
-    }
-    for key in replace_list.keys():
-      source = source.replace(key, replace_list[key])
-    return source
+    return source.translate(INVALID_FILENAME_TABLE)
 
 def truncate_string_in_byte_size(unicode_string, size=180):
-  if len(unicode_string.encode('utf8')) > size:
-    return unicode_string.encode('utf8')[:size].decode('utf8', 'ignore').strip() + '...'
+  encoded = unicode_string.encode('utf8')
+  if len(encoded) > size:
+    return encoded[:size].decode('utf8', 'ignore').strip() + '...'
   return unicode_string
 
+# database에만 있고 json 파일에는 쓰지 않는 열
+DATABASE_ONLY_KEYS = ('_id', 'download_status', 'download_path', 'relative_path', 'json_hash', 'file_size', 'download_method')
+
+# index 파일을 만들 폴더의 깊이. '<broadcaster> (<login>)/2017/2017-12/2017-12-29/<title>'
+JSON_INDEX_DEPTHS = {
+  'month': 3,
+  'day': 4,
+}
+
+
+def clip_json_data(clip: dict) -> dict:
+  return {key: value for (key, value) in clip.items() if key not in DATABASE_ONLY_KEYS}
+
+
+def clip_json_hash(json_data: dict) -> str:
+  """
+  json 내용의 hash. updated_at은 조회할 때마다 바뀌므로 제외하고
+  실제 클립 정보(조회수, 제목 등)가 바뀌었는지만 봄.
+  """
+  content = {key: value for (key, value) in json_data.items() if key != 'updated_at'}
+  return hashlib.sha1(json.dumps(content, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+def expand_clip(clip: dict) -> dict:
+  clip['vod_url'] = clip['thumbnail_url'][:(clip['thumbnail_url'].index('-preview-'))] + '.mp4'
+  clip['updated_at'] = datetime.now()
+  return clip 
+
+
 class TwitchApi:
-  def __init__(self, databasePath: str, clientId: str, clientSecret: str, streamerId: str, readSize: int, proxy: str):
-    self.database = ClipDatabase(databasePath)
-    self.session = requests.Session()
-    self.authHeader = {}
-     
+  # 벤치마크에서 로컬 서버로 바꿔서 사용함
+  HELIX_URL = "https://api.twitch.tv/helix"
+  OAUTH_URL = "https://id.twitch.tv/oauth2"
+
+  def __init__(
+    self, 
+    databasePath: str, 
+    clientId: str, 
+    clientSecret: str, 
+    streamerId: str, 
+    readSize: int, 
+    proxy: str, 
+    tokenCachePath: str = None, 
+    printIp: bool = False,
+    unifiedTable: bool = None,
+    shared: "TwitchApi" = None
+  ):
+    """
+    shared가 주어지면 그 인스턴스의 database, http client(토큰, rate limit), 
+    다운로드 엔진을 같이 사용함. 여러 스트리머를 한 프로세스에서 처리할 때 사용.
+    unifiedTable은 ClipDatabase의 unified 참고.
+    """
     self.clientId = clientId
     self.clientSecret = clientSecret
     self.proxy = proxy
     self.readSize = readSize
+    # 토큰은 만료되기 전까지 파일에 저장해두고 재사용함
+    self.tokenCachePath = tokenCachePath if tokenCachePath != None else f"{databasePath}.token.json"
+    
+    if shared != None:
+      self.database = shared.database
+      self.client = shared.client
+      self.downloader = shared.downloader
+    else:
+      self.database = ClipDatabase(databasePath, unifiedTable)
+      # 모든 api 요청은 이 client를 통해서 보냄 (rate limit, 재시도, 토큰 갱신)
+      self.client = HttpClient(proxy, refresh_credentials=self.__get_credentials)
+      # 다운로드는 worker 스레드 안에서 처리함 (connection pool, streamlink session 재사용)
+      self.downloader = DownloadEngine(proxy)
+      if not self.__load_cached_credentials():
+        self.__get_credentials()
     
-    self.proxies = {
-      "http": proxy,
-      "https": proxy,
-    }   
+    # 경로를 만들 때 사용하는 값은 한 번만 계산함
+    self.utcOffset = datetime.now(timezone.utc).astimezone().utcoffset()
+    self.createdDirectories = set()
+    self.realDirectories = {}
+    # downloadDirectory -> Inventory
+    self.inventories = {}
     
-    self.__get_credentials()
-    self.broadcasterId = streamerId if self.__is_broadcaster_id(streamerId) else self.__get_broadcaster_id(streamerId)
-    self.loginName = streamerId if not self.__is_broadcaster_id(streamerId) else self.__get_loginName(streamerId)
-    self.database.create_table(self.loginName)
-    self.__print_ip()
+    (self.broadcasterId, self.loginName) = self.__resolve_streamer(streamerId)
+    self.database.create_table(self.loginName, self.broadcasterId)
+    if printIp:
+      self.__print_ip()
   
 
-  def __get(self, url, headers={}) -> dict:
-    headers.update(self.authHeader)
-    if self.proxy == None:
-      res = self.session.get(url, headers=headers)
-    else:
-      res = self.session.get(url, headers=headers, proxies=self.proxies)
-    if not res.ok:
-      raise Exception(res.json())
-    return res.json()
+  def __get(self, url, headers={}, authorize=True) -> dict:
+    return self.client.get(url, headers=headers, authorize=authorize)
   
   def __post(self, url, headers={}, data=None, json=None) -> dict:
-    if self.proxy == None:
-      res = self.session.post(url, headers=headers, data=data, json=json)
-    else:
-      res = self.session.post(url, headers=headers, data=data, json=json, proxies=self.proxies)
-    if not res.ok:
-      raise Exception(res.json())
-    return res.json()
+    return self.client.post(url, headers=headers, data=data, json=json, authorize=False)
   
   def __is_broadcaster_id(self, name):
     try:
@@ -83,29 +141,72 @@ class TwitchApi:
     except:
       return False 
   
-  def __get_broadcaster_id(self, loginName):
+  def __resolve_streamer(self, streamerId):
+    """
+    (broadcaster_id, loginName)을 리턴함.
+    database에 저장된 값이 있으면 요청하지 않음.
+    """
+    is_broadcaster_id = self.__is_broadcaster_id(streamerId)
+    if is_broadcaster_id:
+      user = self.database.get_user(broadcasterId=streamerId)
+    else:
+      user = self.database.get_user(loginName=streamerId)
+    if user != None:
+      return user
+    
     try:
-      api = f"https://api.twitch.tv/helix/users?login={loginName}"
+      if is_broadcaster_id:
+        api = f"{self.HELIX_URL}/users?id={streamerId}"
+      else:
+        api = f"{self.HELIX_URL}/users?login={streamerId}"
       res = self.__get(api)
-      return res['data'][0]['id']
+      broadcasterId = res['data'][0]['id']
+      loginName = res['data'][0]['login']
     except Exception as e:
       print(e)
-      print(f"{loginName} is not valid or credentials is not valid")
+      print(f"{streamerId} is not valid or credentials is not valid")
       raise Exception(e)
+    self.database.save_user(broadcasterId, loginName)
+    return (broadcasterId, loginName)
 
-  def __get_loginName(self, boradcasterId):
+  def __set_credentials(self, access_token):
+    token = f"Bearer {access_token}"
+    self.client.set_auth_header({
+      'Authorization': token,
+      'Client-Id': self.clientId,
+    })
+    return token
+
+  def __load_cached_credentials(self) -> bool:
     try:
-      api = f"https://api.twitch.tv/helix/users?id={boradcasterId}"
-      res = self.__get(api)
-      return res['data'][0]['login']
+      with open(self.tokenCachePath, 'r', encoding='utf-8') as f:
+        cached = json.load(f)
+      # 만료 1시간 전부터는 새로 받음
+      if cached['client_id'] != self.clientId or cached['expires_at'] - 3600 < time.time():
+        return False
+      self.__set_credentials(cached['access_token'])
+      return True
+    except Exception as e:
+      return False
+
+  def __save_cached_credentials(self, access_token, expires_in):
+    try:
+      temp_path = f"{self.tokenCachePath}.tmp"
+      fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+      with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump({
+          'client_id': self.clientId,
+          'access_token': access_token,
+          'expires_at': time.time() + expires_in,
+        }, f)
+      os.replace(temp_path, self.tokenCachePath)
     except Exception as e:
       print(e)
-      print(f"{boradcasterId} is not valid or credentials is not valid")
-      raise Exception(e)
+      print(f'token cache write error. not critical...')
 
   def __get_credentials(self):
     try:
-      api = f"https://id.twitch.tv/oauth2/token?grant_type=client_credentials"
+      api = f"{self.OAUTH_URL}/token?grant_type=client_credentials"
       res = self.__post(
         api,
         headers={
@@ -118,11 +219,8 @@ class TwitchApi:
           'code': self.clientSecret,
         }
       )
-      token = f"Bearer {res['access_token']}"
-      self.authHeader = {
-        'Authorization': token,
-        'Client-Id': self.clientId,
-      }
+      token = self.__set_credentials(res['access_token'])
+      self.__save_cached_credentials(res['access_token'], res.get('expires_in', 0))
       return token
     except Exception as e:
       print(e)
@@ -131,14 +229,14 @@ class TwitchApi:
     
   def __print_ip(self):
     try:
-      res = self.__get('https://ifconfig.co/json')
+      res = self.__get('https://ifconfig.co/json', authorize=False)
       print(res) 
     except Exception as e:
       print(e)
       print(f'ip checker error. not critical...')
   
   def read_clips(self, after, started_at, ended_at):    
-    api = f"https://api.twitch.tv/helix/clips?broadcaster_id={self.broadcasterId}&first={self.readSize}"
+    api = f"{self.HELIX_URL}/clips?broadcaster_id={self.broadcasterId}&first={self.readSize}"
     if after != None and len(after) != 0:
       api += f"&after={after}"
     if started_at != None and len(started_at) != 0:
@@ -148,7 +246,7 @@ class TwitchApi:
     return self.__get(api)
 
   
-  def read_all_clips(self, from_database_date: bool):
+  def read_all_clips(self, from_database_date: bool, workers: int = 1, refresh_tiers: list = None):
     """_summary_
     클립 기능의 최초 도입 날짜는 2016-05-26T00:00:00Z임
     started_at과 ended_at을 명시하지 않고 조회하면
@@ -171,79 +269,258 @@ class TwitchApi:
     가장 최신의 created_at을 가져와서
     그 범위부터 요청함.
     
+    조회 구간은 windowPlanner가 이전 조회 때 기록된 구간별 
+    클립 수를 보고 정함. 결과가 개수 제한에 가까운 구간은 
+    나눠서 다시 요청하고, 클립이 적은 연속된 달은 합쳐서 요청함.
+    
+    각 구간은 서로 독립적이므로 workers 개의 스레드가
+    여러 구간을 동시에 요청함. 한 구간 안의 페이지는 
+    cursor 순서대로 요청하고, 결과는 하나의 writer 스레드가 
+    database에 기록함.
+    
+    Args:
+        from_database_date: database의 가장 최신 달부터 요청
+        workers: 동시에 요청할 구간의 수
+        refresh_tiers: 주어지면 조회수 갱신 모드로 동작함. 
+          windowPlanner.parse_refresh_tiers의 결과로, 구간의 나이에 따라 
+          마지막으로 조회한 지 충분히 지난 구간만 다시 요청함.
+    
     Raises:
         KeyboardInterrupt: _description_
     """
-    def date_range_generator(start_year: int, start_month: int):
-      today = datetime.now()
-      today_year = today.year 
-      today_month = today.month 
-      
-      year = start_year 
-      month = start_month
-      while True:
-        if f'{year}-{str(month).zfill(2)}' > f'{today_year}-{str(today_month).zfill(2)}':
-          break
-        started_at = f"{year}-{str(month).zfill(2)}-01T00:00:00Z"
-        if month == 12:
-          month = 1 
-          year += 1
-        else:
-          month += 1
-        # 마지막 날 5분으로 설정해서 누락되는 클립 없는가 확인
-        ended_at = f"{year}-{str(month).zfill(2)}-01T00:05:00Z" 
-        yield (started_at, ended_at)
+    def read_window(window: tuple, after: str):
+      """
+      한 구간의 페이지들을 after부터 순서대로 읽어서 output 큐에 넣음.
+      페이지마다 (window, 'page', (클립 목록, 다음 cursor))를,
+      구간이 끝나면 (window, 'done', 성공 여부)를 넣어서 알림.
+      """
+      started_at = windowPlanner.format_date(window[0])
+      # 구간 끝에 약간 더 요청해서 누락되는 클립 없는가 확인
+      ended_at = windowPlanner.format_date(window[1] + windowPlanner.WINDOW_OVERLAP)
+      clips = {}
+      tries = 0
+      window_started_at = time.perf_counter()
+      while tries < 3 and not stop_event.is_set():
+        try:
+          with registry.timer('crawl_page_seconds'):
+            res_json = self.read_clips(after, started_at, ended_at)
+          clips = res_json['data']
+          clips = [expand_clip(clip) for clip in clips]
+          pagination = res_json['pagination']
+          next_cursor = pagination.get('cursor', "")
+          put_output((window, 'page', (clips, next_cursor)))
+          if len(next_cursor) == 0:
+            break
+          after = next_cursor
+        except Exception as e:
+          print(f"\n[{datetime.now()}] {tries+1}-th try {e}")
+          tries += 1
+          if after != None and len(after) != 0 and tries == 1:
+            # 저장된 cursor가 만료되었을 수 있으므로 구간 처음부터 다시 요청함
+            print(f"\n[{datetime.now()}] restart ({started_at}, {ended_at}) from the first page")
+            after = ""
+      if tries >= 3:
+        print(f"\n[{datetime.now()}] Failed while requesting ({after}, {started_at}, {ended_at}) => {clips}", flush=True)
+      registry.observe('crawl_window_seconds', time.perf_counter() - window_started_at)
+      put_output((window, 'done', tries < 3 and not stop_event.is_set()))
     
-    def expand_clip(clip: dict):
-      clip['vod_url'] = clip['thumbnail_url'][:(clip['thumbnail_url'].index('-preview-'))] + '.mp4'
-      clip['updated_at'] = datetime.now()
-      return clip 
+    def put_output(item):
+      # 메인 스레드가 멈춘 경우 영원히 대기하지 않도록 함
+      while not stop_event.is_set():
+        try:
+          output.put(item, timeout=1)
+          return
+        except queue.Full:
+          continue
+    
+    def submit(window: tuple, after: str = "", clip_count: int = 0):
+      nonlocal remaining_windows
+      remaining_windows += 1
+      window_clips[window] = clip_count
+      futures.append(executor.submit(read_window, window, after))
+    
+    # 이전 조회가 중단되었거나 실패한 구간은 저장된 cursor부터 이어서 요청함
+    unfinished_windows = [
+      ((windowPlanner.parse_date(started_at), windowPlanner.parse_date(ended_at)), cursor, clip_count)
+      for (started_at, ended_at, status, cursor, clip_count) in self.database.get_unfinished_crawl_windows(self.loginName)
+    ]
+    if len(unfinished_windows) > 0:
+      print(f"resume {len(unfinished_windows)} unfinished windows from the last crawl")
     
     start_year, start_month = 2016, 1
-    if from_database_date:
+    if from_database_date and refresh_tiers == None:
       (start_year, start_month) = self.database.get_latest_created_at(self.loginName)
     
+    # 이전에 기록된 구간별 클립 수로 조회 구간을 나누거나 합침
+    records = [
+      (windowPlanner.parse_date(started_at), windowPlanner.parse_date(ended_at), clip_count, updated_at) 
+      for (started_at, ended_at, clip_count, updated_at) in self.database.get_windows(self.loginName)
+    ]
+    planned_windows = windowPlanner.plan_windows(
+      windowPlanner.month_windows(start_year, start_month),
+      [(started_at, ended_at, clip_count) for (started_at, ended_at, clip_count, _) in records]
+    )
+    if refresh_tiers != None:
+      num_of_planned_windows = len(planned_windows)
+      planned_windows = windowPlanner.due_windows(planned_windows, records, refresh_tiers)
+      print(f"refresh {len(planned_windows)} of {num_of_planned_windows} windows")
+    # 이어서 요청하는 구간과 겹치는 구간은 다시 요청하지 않음
+    planned_windows = [
+      (started_at, ended_at) for (started_at, ended_at) in planned_windows
+      if not any(window[0] < ended_at and window[1] > started_at for (window, _, _) in unfinished_windows)
+    ]
+    self.database.start_crawl(self.loginName, [
+      (windowPlanner.format_date(started_at), windowPlanner.format_date(ended_at)) 
+      for (started_at, ended_at) in planned_windows
+    ])
+    windows = unfinished_windows + [(window, "", 0) for window in planned_windows]
+    
+    if len(windows) == 0:
+      return
+    workers = max(1, min(workers, len(windows)))
+    output = queue.Queue(maxsize=workers * 4)
+    stop_event = threading.Event()
+    futures = []
+    window_clips = {}
+    
     num_of_clips = 0
+    # 구간이 겹치는 부분에서 같은 클립을 여러 번 받으므로 이번 실행에서 본 클립은 다시 쓰지 않음
+    seen_clip_ids = set()
+    num_of_new_clips = 0
+    num_of_changed_clips = 0
+    num_of_windows = 0
+    num_of_failed_windows = 0
+    remaining_windows = 0
     with tqdm(unit='clip') as progress_bar:
-      for (started_at, ended_at) in date_range_generator(start_year, start_month):
-        progress_bar.set_description_str(f"[{started_at} ~ {ended_at}]")
-        clips = {}
-        after = ""
-        tries = 0
-        while tries < 3:
-          try:
-            res_json = self.read_clips(after, started_at, ended_at)
-            clips = res_json['data']
-            clips = [expand_clip(clip) for clip in clips]
-            pagination = res_json['pagination']
-            num_of_clips += len(clips)
-            if len(clips) > 0:
-              self.database.insertmany_item(self.loginName, clips)
+      with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+          for (window, after, clip_count) in windows:
+            submit(window, after, clip_count)
+          # 모든 worker의 결과는 database writer 스레드 하나가 기록함
+          while remaining_windows > 0:
+            (window, kind, value) = output.get()
+            started_at = windowPlanner.format_date(window[0])
+            ended_at = windowPlanner.format_date(window[1])
+            if kind == 'page':
+              (clips, next_cursor) = value
+              window_clips[window] += len(clips)
+              num_of_clips += len(clips)
+              registry.inc('crawl_clips_total', len(clips), streamer=self.loginName)
+              unique_clips = {}
+              for clip in clips:
+                if clip['id'] not in seen_clip_ids:
+                  unique_clips[clip['id']] = clip
+              seen_clip_ids.update(unique_clips.keys())
+              # database에 있고 조회수도 같은 클립은 쓰지 않음
+              (new_clips, changed_clips) = self.database.split_changed_clips(self.loginName, list(unique_clips.values()))
+              num_of_new_clips += len(new_clips)
+              num_of_changed_clips += len(changed_clips)
+              registry.inc('crawl_clips_written_total', len(new_clips), result='new')
+              registry.inc('crawl_clips_written_total', len(changed_clips), result='changed')
+              if len(new_clips) + len(changed_clips) > 0:
+                self.database.insertmany_item(self.loginName, new_clips + changed_clips)
+              self.database.checkpoint_crawl_window(self.loginName, started_at, ended_at, 'pending', next_cursor, window_clips[window])
               progress_bar.update(len(clips))
-            if 'cursor' not in pagination:
-              break
-            after = pagination['cursor']
-          except KeyboardInterrupt:
-            raise KeyboardInterrupt
-          except Exception as e:
-            print(f"\n[{datetime.now()}] {tries+1}-th try {e}")
-            tries += 1
-        if tries >= 3:
-          print(f"\n[{datetime.now()}] Failed while requesting ({after}, {started_at}, {ended_at}) => {clips}", flush=True)
+              continue
+            
+            remaining_windows -= 1
+            num_of_windows += 1
+            clip_count = window_clips.pop(window)
+            if value == True and clip_count >= windowPlanner.SPLIT_THRESHOLD and windowPlanner.is_splittable(window):
+              # 결과 개수 제한에 걸렸을 수 있으므로 반으로 나눠서 다시 요청함
+              parts = windowPlanner.split_window(window)
+              registry.inc('crawl_windows_total', result='split')
+              self.database.checkpoint_crawl_window(self.loginName, started_at, ended_at, 'split', "", clip_count)
+              self.database.add_crawl_windows(self.loginName, [
+                (windowPlanner.format_date(part[0]), windowPlanner.format_date(part[1])) for part in parts
+              ])
+              for part in parts:
+                submit(part)
+            elif value == True:
+              registry.inc('crawl_windows_total', result='done')
+              self.database.checkpoint_crawl_window(self.loginName, started_at, ended_at, 'done', "", clip_count)
+              self.database.record_window(self.loginName, started_at, ended_at, clip_count)
+            elif not stop_event.is_set():
+              # 마지막 cursor는 그대로 두고 다음 실행 때 다시 시도함
+              num_of_failed_windows += 1
+              registry.inc('crawl_windows_total', result='failed')
+              self.database.fail_crawl_window(self.loginName, started_at, ended_at)
+            progress_bar.set_description_str(f"[{started_at} ~ {ended_at}] {num_of_windows}/{num_of_windows + remaining_windows} windows")
+        except KeyboardInterrupt:
+          print("KeyboardInterrupt! wait for currently running requests.")
+          raise KeyboardInterrupt
+        finally:
+          # 어떤 이유로 멈추더라도 output 큐에서 기다리는 worker가 끝나도록 함
+          stop_event.set()
+          for future in futures:
+            future.cancel()
+          # 중단되어도 이미 받은 클립과 cursor는 database에 남도록 함
+          self.database.flush()
+    if num_of_failed_windows > 0:
+      print(f"{num_of_failed_windows} windows failed. they will be requested again on the next run")
     print(f"total clips with duplicated: {num_of_clips}")
+    print(f"unique clips: {len(seen_clip_ids)} (new {num_of_new_clips}, changed {num_of_changed_clips}, unchanged {len(seen_clip_ids) - num_of_new_clips - num_of_changed_clips})")
 
 
-  def path_constructor(self, downloadDirectory: str, clip: dict):
-    """ 
-    make parent directories and 
-    returns full-path-without-file-extension
+  def read_newest_clips(self, lookback: timedelta) -> tuple:
+    """
+    지금부터 lookback 전까지의 구간만 조회해서 database에 반영함.
+    (새로 추가된 클립의 database 행 목록, 조회수가 바뀐 클립 수)를 리턴함.
     """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    started_at = windowPlanner.format_date(now - lookback)
+    ended_at = windowPlanner.format_date(now + windowPlanner.WINDOW_OVERLAP)
+    clips = {}
+    after = ""
+    while True:
+      res_json = self.read_clips(after, started_at, ended_at)
+      for clip in res_json['data']:
+        clips[clip['id']] = expand_clip(clip)
+      after = res_json['pagination'].get('cursor', "")
+      if len(after) == 0:
+        break
     
+    (new_clips, changed_clips) = self.database.split_changed_clips(self.loginName, list(clips.values()))
+    if len(new_clips) + len(changed_clips) == 0:
+      return ([], 0)
+    self.database.insertmany_item(self.loginName, new_clips + changed_clips)
+    # 다운로드 결과를 _id로 기록하므로 database에 들어간 행을 다시 읽음
+    self.database.flush()
+    return (self.database.get_clips(self.loginName, [clip['id'] for clip in new_clips]), len(changed_clips))
+
+
+  def iterate_newest_incomplete_rows(self, lookback: timedelta, minView: int):
+    """
+    지금부터 lookback 전까지 만들어진 클립 중 아직 받지 못했고 조회수가 minView 이상인 행.
+    처음 봤을 때는 조회수가 적었던 클립과 다운로드에 실패한 클립도 포함됨.
+    """
+    started_at = windowPlanner.format_date(datetime.now(timezone.utc).replace(tzinfo=None) - lookback)
+    # 끝난 다운로드의 결과가 반영된 뒤에 읽어야 같은 클립을 다시 받지 않음
+    self.database.flush()
+    return self.database.iterate_rows(
+      self.loginName, 
+      "created_at >= ? AND view_count >= ? AND download_status != 1", 
+      (started_at, minView), 
+      order='oldest'
+    )
+
+
+  def watch(self, downloadDirectory: str, concurrency: int, saveJson: bool, minView: int, minInterval: float, maxInterval: float):
+    watcher.watch([self], downloadDirectory, concurrency, saveJson, minView, minInterval, maxInterval)
+
+
+  def relative_path(self, clip: dict) -> str:
+    """
+    다운로드 폴더 기준의 경로 (확장자 없음).
+    database에 저장된 값이 있으면 그대로 사용함.
+    """
+    if clip.get('relative_path'):
+      return clip['relative_path']
     
     """ 
     '2017-12-29T13:12:23Z' -> '2017-12-29T13:12:23'
     """
-    created_at = datetime.fromisoformat(clip['created_at'][:-1]) + datetime.now(timezone.utc).astimezone().utcoffset()
+    created_at = datetime.fromisoformat(clip['created_at'][:-1]) + self.utcOffset
     year = str(created_at.year).zfill(4)
     month = str(created_at.month).zfill(2)
     day = str(created_at.day).zfill(2)
@@ -256,93 +533,121 @@ class TwitchApi:
     clip_id = clip["id"][:10]
     title = f"[{year}{month}{day}-{hour}{minute}{second}] {clip_title} ({clip_id})"
     title = replace_invalid_filename(title)
-    fileDirectory = os.path.join(
-      downloadDirectory, 
+    return os.path.join(
       broadcasterDirectory, 
       year,
       f"{year}-{month}",
       f"{year}-{month}-{day}",
+      title,
     )
-    os.makedirs(fileDirectory, exist_ok=True)
-    return os.path.join(fileDirectory, title)
+
+
+  def path_constructor(self, downloadDirectory: str, clip: dict):
+    """ 
+    make parent directories and 
+    returns full-path-without-file-extension
+    
+    이미 만든 폴더는 기억해두고 다시 만들지 않음
+    """
+    path = os.path.join(downloadDirectory, self.relative_path(clip))
+    fileDirectory = os.path.dirname(path)
+    if fileDirectory not in self.createdDirectories:
+      os.makedirs(fileDirectory, exist_ok=True)
+      self.createdDirectories.add(fileDirectory)
+    return path
+
+
+  def real_directory(self, downloadDirectory: str) -> str:
+    if downloadDirectory not in self.realDirectories:
+      self.realDirectories[downloadDirectory] = os.path.realpath(downloadDirectory)
+    return self.realDirectories[downloadDirectory]
 
 
   def save_json(self, clip: dict, filename: str):
     try:
-      json_data = clip.copy()
-      json_data.pop('_id', None)
-      json_data.pop('download_status', None)
-      json_data.pop('download_path', None)
+      json_data = clip_json_data(clip)
       with open(filename, 'w', encoding="utf-8") as f:
         json.dump(json_data, f, indent=2, ensure_ascii=False)
+      clip['json_hash'] = clip_json_hash(json_data)
       return (True, clip) 
     except Exception as e:
       return (False, clip)
     
 
-  def download_clip(self, clip: dict, downloadDirectory: str, saveJson: bool, skipDownloadIfExists: bool) -> dict:
-    def streamlink_method(commands: list):
-      try:
-        completed_process = subprocess.run(
-          commands,
-          capture_output=True
-        )
-        return_code = completed_process.returncode
-        return (return_code == 0)
-      except Exception as e:
-        # print(f"streamlink_method failed | {e}", flush=True)
-        return False 
-    
-    def request_method(vod_url, filename, proxy={}):
-      try:
-        res = requests.get(
-          vod_url, 
-          stream=True, 
-          proxies=proxy
-        ) 
-        if not res.ok:
-          return False 
-        with open(filename, 'wb') as f: 
-          for chunk in res.iter_content(chunk_size=1024*1024): 
-            if chunk:
-              f.write(chunk)
-        return True
-      except Exception as e:
-        # print(f"request_method failed | {e}", flush=True)
-        return False 
+  def __exists(self, downloadDirectory: str, relative_path: str, extension: str) -> bool:
+    """
+    reconcile_inventory로 폴더를 훑었으면 그 목록에서 찾고
+    아니면 파일 시스템에 직접 물어봄
+    """
+    inventory = self.inventories.get(downloadDirectory, None)
+    if inventory == None:
+      return os.path.exists(os.path.join(downloadDirectory, f"{relative_path}{extension}"))
+    if extension == '.mp4':
+      return inventory.has_video(relative_path)
+    return inventory.has_json(relative_path)
+
+
+  def reconcile_inventory(self, downloadDirectory: str, saveJson: bool) -> int:
+    """
+    스트리머의 폴더를 한 번 훑어서 이미 받은 클립 파일 목록을 만들고
+    아직 받지 않은 것으로 되어 있지만 파일이 있는 클립을 한 번에 받은 것으로 표시함.
+    saveJson이면 json 파일까지 있어야 받은 것으로 봄.
+    표시한 클립의 수를 리턴함.
+    """
+    inventory = scan_streamer_directories(downloadDirectory, self.loginName)
+    self.inventories[downloadDirectory] = inventory
+    realDirectory = self.real_directory(downloadDirectory)
     
+    clips = []
+    for clip in self.database.iterate_rows(self.loginName, "download_status != 1"):
+      video = inventory.find_video(self.relative_path(clip))
+      if video == None or video[1] == 0:
+        continue
+      (relative_path, size) = video
+      if saveJson == True and not inventory.has_json(relative_path):
+        continue
+      # 전에 받았을 때와 크기가 다르면 받다 만 파일이므로 다시 받음
+      if clip.get('file_size', -1) > 0 and clip['file_size'] != size:
+        continue
+      clip['download_status'] = 1
+      clip['file_size'] = size
+      # 어떤 방법으로 받은 파일인지 알 수 없음
+      clip['download_method'] = ''
+      clip['relative_path'] = relative_path
+      clip['download_path'] = os.path.join(realDirectory, f"{relative_path}.mp4")
+      clips.append(clip)
+    self.database.update_download_infos(self.loginName, clips)
+    self.database.flush()
+    print(f"[{self.loginName}] {len(inventory)} clip files found. {len(clips)} clips are marked as downloaded")
+    return len(clips)
+
+
+  def download_clip(self, clip: dict, downloadDirectory: str, saveJson: bool, skipDownloadIfExists: bool) -> dict:
     filename = self.path_constructor(downloadDirectory, clip)
     clip_path = f'{filename}.mp4' # json 저장 때문에 다른 변수 사용함
     
     # set status as pending
     clip['download_status'] = 2
-    clip['download_path'] = os.path.realpath(clip_path)
+    clip['relative_path'] = self.relative_path(clip)
+    clip['download_path'] = os.path.join(self.real_directory(downloadDirectory), f"{clip['relative_path']}.mp4")
     
-    if not ((skipDownloadIfExists == True) and (os.path.exists(clip_path))): 
-      success = False 
-      
-      proxy_option = [] if self.proxy == None else ["--http-proxy", self.proxy]
-      commands = [sys.executable, "-m", "streamlink", "-o", clip_path, "--force"] + proxy_option + [clip["url"], "best"]
-      for _ in range(2):
-        success = streamlink_method(commands)
-        if success: 
-          break 
-        time.sleep(2) 
-      
-      if not success:
-        print(f"\n[{datetime.now()}] Use request method for {clip['created_at']}-{clip['url']}", flush=True)
-        for _ in range(2):
-          success = request_method(clip['vod_url'], clip_path, self.proxies)
-          if success: 
-            break 
-          time.sleep(2)
-      
-      if not success:
+    if not ((skipDownloadIfExists == True) and self.__exists(downloadDirectory, clip['relative_path'], '.mp4')): 
+      method = self.downloader.download(clip, clip_path)
+      if method == None:
+        registry.inc('clips_downloaded_total', streamer=self.loginName, result='failure')
         print(f"\n[{datetime.now()}] Failed to download {clip['created_at']}-{clip['url']}", flush=True)
         return clip 
+      registry.inc('clips_downloaded_total', streamer=self.loginName, result='success')
+      # verify_downloads에서 비교할 크기. request로 받으면 Content-Length와 같은지 이미 확인함
+      clip['file_size'] = os.path.getsize(clip_path)
+      # vod_url로 받은 파일만 잘렸을 때 Range 요청으로 이어서 받을 수 있음
+      clip['download_method'] = method
+    else:
+      registry.inc('clips_downloaded_total', streamer=self.loginName, result='skipped')
+      clip['download_method'] = ''
 
     if saveJson == True:
-      if not ((skipDownloadIfExists == True) and (os.path.exists(f'{filename}.json'))): 
+      if not ((skipDownloadIfExists == True) and self.__exists(downloadDirectory, clip['relative_path'], '.json')): 
         self.save_json(clip, f'{filename}.json')
 
     # set as downloaded
@@ -358,8 +663,15 @@ class TwitchApi:
     forceDownload: bool, 
     skipDownloadIfExists: bool, 
     minView: int, 
-    maxClips: int
+    maxClips: int,
+    order: str = 'rowid',
+    bandwidthLimit: int = 0,
+    hostConnections: int = 0,
+    autoTune: bool = False
   ):
+    self.downloader.configure(concurrency, bandwidthLimit, hostConnections, autoTune)
+    if skipDownloadIfExists == True:
+      self.reconcile_inventory(downloadDirectory, saveJson)
     def clip_handler(clip):
       return self.download_clip(clip, downloadDirectory, saveJson, skipDownloadIfExists)
     self.database.iterate_incomplete_rows(
@@ -368,19 +680,132 @@ class TwitchApi:
       concurrency, 
       minView, 
       maxClips, 
-      forceDownload
+      forceDownload,
+      order
     )
   
   
-  def write_json_from_database(self, downloadDirectory: str, concurrency: int):
+  def write_json_from_database(self, downloadDirectory: str, concurrency: int, jsonIndex: str = None):
+    """
+    다운로드된 클립의 json 파일을 다시 씀.
+    마지막으로 쓴 내용의 hash와 같고 파일도 있으면 다시 쓰지 않음.
+    jsonIndex가 'day' 또는 'month'면 클립마다 쓰는 대신 날짜(월)별 index 파일 하나에 모아서 씀.
+    """
+    if jsonIndex != None:
+      return self.write_json_index(downloadDirectory, jsonIndex)
+    
+    inventory = scan_streamer_directories(downloadDirectory, self.loginName)
+    counts = {'written': 0, 'unchanged': 0}
+    counts_lock = threading.Lock()
     def save_json_clip_handler(clip):
+      relative_path = self.relative_path(clip)
+      if clip_json_hash(clip_json_data(clip)) == clip.get('json_hash') and inventory.has_json(relative_path):
+        with counts_lock:
+          counts['unchanged'] += 1
+        return (True, clip)
       filename = self.path_constructor(downloadDirectory, clip)
-      return self.save_json(clip, f'{filename}.json')
+      (status, clip) = self.save_json(clip, f'{filename}.json')
+      if status:
+        self.database.update_json_hashes(self.loginName, [clip])
+        with counts_lock:
+          counts['written'] += 1
+      return (status, clip)
     
-    self.database.iterate_completed_rows(
-      self.loginName, 
-      save_json_clip_handler,
-      concurrency,
-    )
+    try:
+      self.database.iterate_completed_rows(
+        self.loginName, 
+        save_json_clip_handler,
+        concurrency,
+      )
+    finally:
+      self.database.flush()
+    print(f"[{self.loginName}] {counts['written']} json files written. {counts['unchanged']} unchanged files skipped")
+
+
+  def write_json_index(self, downloadDirectory: str, period: str):
+    """
+    다운로드된 클립 정보를 날짜(day) 또는 월(month) 폴더마다 하나의 index 파일로 씀.
+    '<broadcaster> (<login>)/2017/2017-12/2017-12.json' 처럼 폴더 이름으로 파일을 만듦.
+    내용이 마지막으로 쓴 것과 같으면 다시 쓰지 않음.
+    """
+    if period not in JSON_INDEX_DEPTHS:
+      raise Exception(f"unknown json index {period}. one of {list(JSON_INDEX_DEPTHS.keys())}")
+    depth = JSON_INDEX_DEPTHS[period]
+    hashes = self.database.get_json_index_hashes()
+    counts = {'written': 0, 'unchanged': 0}
     
-  
+    def write_index(directory: str, clips: list):
+      relative_path = os.path.join(directory, f"{os.path.basename(directory)}.json")
+      path = os.path.join(downloadDirectory, relative_path)
+      index_hash = hashlib.sha1(''.join([clip_json_hash(clip) for clip in clips]).encode('utf-8')).hexdigest()
+      if hashes.get(relative_path) == index_hash and os.path.exists(path):
+        counts['unchanged'] += 1
+        return
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      temp_path = f"{path}.tmp"
+      with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(clips, f, indent=2, ensure_ascii=False)
+      os.replace(temp_path, path)
+      self.database.save_json_index_hash(relative_path, index_hash)
+      counts['written'] += 1
+    
+    # 행마다 저장된 경로는 utc offset이나 폴더 구조가 달랐을 수 있으므로
+    # 생성 시간 순서여도 같은 폴더의 클립이 연달아 나온다고 볼 수 없음.
+    # 모두 읽어서 폴더마다 모은 뒤에 index 파일을 한 번씩만 씀
+    groups = {}
+    try:
+      for clip in tqdm(self.database.iterate_rows(self.loginName, "download_status = 1", order='oldest'), unit='clip'):
+        parts = self.relative_path(clip).split(os.sep)
+        groups.setdefault(os.path.join(*parts[:depth]), []).append(clip_json_data(clip))
+      for (directory, clips) in groups.items():
+        write_index(directory, clips)
+    finally:
+      self.database.flush()
+    print(f"[{self.loginName}] {counts['written']} {period} index files written. {counts['unchanged']} unchanged files skipped")
+
+
+  def verify_downloads(self, downloadDirectory: str, workers: int = None) -> int:
+    """
+    받은 것으로 되어 있는 클립 파일을 여러 프로세스에서 나눠서 검사함.
+    파일 전체를 읽지 않고 mp4 box header(ftyp, moov, mdat)만 읽고 다운로드할 때 기록한 크기와 비교함.
+    잘못된 클립은 한 번에 다운로드 대상으로 되돌리고
+    vod_url로 받았다가 잘린 파일은 이어서 받도록 `.part`로, 나머지는 `.corrupt`로 이름을 바꿈.
+    streamlink로 받은 파일에 vod_url의 나머지를 붙이면 안 되므로 처음부터 다시 받음.
+    되돌린 클립의 수를 리턴함.
+    """
+    def items():
+      for clip in self.database.iterate_rows(self.loginName, "download_status = 1"):
+        if clip.get('relative_path'):
+          path = os.path.join(downloadDirectory, f"{clip['relative_path']}.mp4")
+        else:
+          path = clip['download_path']
+        expected_size = clip.get('file_size', -1)
+        yield ((clip['_id'], expected_size, clip.get('download_method')), path, expected_size)
+
+    bad_ids = []
+    sizes = []
+    counts = {}
+    try:
+      for ((_id, expected_size, method), path, result, size, reason) in tqdm(verifier.verify_files(items(), workers), unit='file'):
+        counts[result] = counts.get(result, 0) + 1
+        registry.inc('verify_files_total', streamer=self.loginName, result=result)
+        if result == verifier.OK:
+          if expected_size == None or expected_size <= 0:
+            sizes.append((_id, size))
+          continue
+        print(f"\n[{datetime.now()}] [{self.loginName}] {result} {path} {reason}", flush=True)
+        bad_ids.append(_id)
+        if result != verifier.MISSING:
+          extension = PART_EXTENSION if result == verifier.TRUNCATED and method == 'request' else '.corrupt'
+          try:
+            if not os.path.exists(f"{path}{extension}"):
+              os.replace(path, f"{path}{extension}")
+          except OSError as e:
+            print(f"\n[{datetime.now()}] [{self.loginName}] failed to move {path}: {e}", flush=True)
+    finally:
+      # 크기가 기록되지 않았던 클립도 검사를 통과했으면 크기를 기록해서 다음에 비교함
+      self.database.update_file_sizes(self.loginName, sizes)
+      self.database.reset_download_status(self.loginName, bad_ids)
+      self.database.flush()
+    print(f"[{self.loginName}] {sum(counts.values())} files verified. {', '.join([f'{count} {result}' for (result, count) in sorted(counts.items())])}. {len(bad_ids)} clips are marked as not downloaded")
+    return len(bad_ids)
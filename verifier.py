@@ -0,0 +1,113 @@
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+from database import bounded_map
+
+
+# 클립 mp4 파일에 꼭 있어야 하는 최상위 box
+REQUIRED_BOXES = ('ftyp', 'moov', 'mdat')
+# 한 프로세스에 한 번에 넘기는 파일 수. 파일마다 넘기면 프로세스 간 통신이 더 오래 걸림
+VERIFY_CHUNK_SIZE = 64
+
+# 검사 결과
+OK = 'ok'
+MISSING = 'missing'
+TRUNCATED = 'truncated'
+CORRUPT = 'corrupt'
+
+
+def read_boxes(f, file_size: int) -> list:
+  """
+  최상위 box의 (type, offset, size) 목록. box header만 읽고 내용은 seek으로 건너뜀.
+  size == 1이면 header 뒤의 64비트 largesize를, size == 0이면 파일 끝까지를 크기로 봄.
+  box가 파일 끝을 넘어가면 TRUNCATED, header가 잘못되었으면 CORRUPT를 raise함.
+  """
+  boxes = []
+  offset = 0
+  while offset < file_size:
+    f.seek(offset)
+    header = f.read(8)
+    if len(header) < 8:
+      raise ValueError(TRUNCATED)
+    (size, box_type) = struct.unpack('>I4s', header)
+    header_size = 8
+    if size == 1:
+      largesize = f.read(8)
+      if len(largesize) < 8:
+        raise ValueError(TRUNCATED)
+      size = struct.unpack('>Q', largesize)[0]
+      header_size = 16
+    elif size == 0:
+      size = file_size - offset
+    if size < header_size:
+      raise ValueError(CORRUPT)
+    if offset + size > file_size:
+      raise ValueError(TRUNCATED)
+    boxes.append((box_type.decode('latin-1'), offset, size))
+    offset += size
+  return boxes
+
+
+def check_mp4(path: str, expectedSize: int = -1) -> tuple:
+  """
+  (결과, 파일 크기, 설명). 파일 전체를 읽지 않고 최상위 box header만 읽음.
+  expectedSize가 0보다 크면 다운로드할 때 기록한 크기와도 비교함.
+  """
+  try:
+    file_size = os.path.getsize(path)
+  except OSError:
+    return (MISSING, -1, "file not found")
+  if expectedSize != None and expectedSize > 0 and file_size != expectedSize:
+    result = TRUNCATED if file_size < expectedSize else CORRUPT
+    return (result, file_size, f"size {file_size} != expected {expectedSize}")
+  if file_size == 0:
+    return (TRUNCATED, 0, "empty file")
+
+  try:
+    with open(path, 'rb') as f:
+      boxes = read_boxes(f, file_size)
+  except ValueError as e:
+    return (str(e), file_size, "bad box header")
+  except OSError as e:
+    return (MISSING, file_size, str(e))
+
+  types = [box[0] for box in boxes]
+  if types[0] != 'ftyp':
+    return (CORRUPT, file_size, f"first box is {types[0]!r}")
+  missing = [box_type for box_type in REQUIRED_BOXES if box_type not in types]
+  if len(missing) > 0:
+    # mdat이 moov보다 앞에 있는 파일은 끝의 moov까지 받지 못하면 moov가 없음
+    return (TRUNCATED if 'mdat' in types else CORRUPT, file_size, f"no {', '.join(missing)} box")
+  return (OK, file_size, '')
+
+
+def check_files(items: list) -> list:
+  """
+  [(key, path, expectedSize)] -> [(key, path, 결과, 파일 크기, 설명)]
+  ProcessPoolExecutor에서 실행되므로 모듈 함수여야 함
+  """
+  return [(key, path) + check_mp4(path, expectedSize) for (key, path, expectedSize) in items]
+
+
+def chunks(items, size: int):
+  chunk = []
+  for item in items:
+    chunk.append(item)
+    if len(chunk) >= size:
+      yield chunk
+      chunk = []
+  if len(chunk) > 0:
+    yield chunk
+
+
+def verify_files(items, workers: int = None):
+  """
+  [(key, path, expectedSize)]를 CPU 코어 수만큼의 프로세스에서 나눠서 검사하고
+  (key, path, 결과, 파일 크기, 설명)을 끝난 순서대로 넘겨줌.
+  items는 generator여도 되고 한 번에 workers * 2 묶음까지만 제출함.
+  """
+  workers = workers if workers != None and workers > 0 else (os.cpu_count() or 1)
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    for results in bounded_map(executor, check_files, chunks(items, VERIFY_CHUNK_SIZE), workers * 2):
+      yield from results
@@ -0,0 +1,112 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+from metrics import registry
+import windowPlanner
+
+
+def watch(
+  apis: list,
+  downloadDirectory: str,
+  concurrency: int,
+  saveJson: bool,
+  minView: int,
+  minInterval: float,
+  maxInterval: float,
+  lookback = windowPlanner.WATCH_LOOKBACK
+):
+  """
+  프로세스를 띄워둔 채로 스트리머마다 최근 구간(lookback)만 주기적으로 조회하고
+  새로 생긴 클립은 database를 다시 훑지 않고 바로 다운로드 스레드 풀에 넘김.
+  조회할 때마다 최근 구간에서 아직 받지 못한 클립(조회수가 나중에 minView를 넘었거나
+  다운로드에 실패한 클립)도 다시 넘김.
+  조회 간격은 최근에 새 클립이 생긴 속도에 따라서 minInterval ~ maxInterval 초 사이에서 정함.
+  Ctrl-C로 멈출 때까지 실행함.
+
+  apis: TwitchApi 목록. 여러 스트리머면 database와 다운로드 엔진을 같이 사용함.
+  """
+  # loginName -> 조회 상태
+  states = {
+    api.loginName: {'next_poll': 0, 'polled_at': None, 'rate': 0.0, 'interval': minInterval}
+    for api in apis
+  }
+
+  # 다운로드 중인 (loginName, _id). 끝나기 전에 같은 클립을 다시 넘기지 않음
+  queued = set()
+
+  def download(api, clip: dict):
+    try:
+      return (api, api.download_clip(clip, downloadDirectory, saveJson, False))
+    except Exception as e:
+      # 실패한 것으로 기록하고 다음 조회 때 다시 받음
+      print(f"\n[{datetime.now()}] [{api.loginName}] download error {e}", flush=True)
+      return (api, clip)
+
+  def record(api, clip: dict):
+    queued.discard((api.loginName, clip['_id']))
+    api.database.update_download_info(api.loginName, clip)
+
+  def poll(api):
+    state = states[api.loginName]
+    now = time.monotonic()
+    try:
+      (new_clips, num_of_changed_clips) = api.read_newest_clips(lookback)
+    except Exception as e:
+      print(f"\n[{datetime.now()}] [{api.loginName}] watch error {e}", flush=True)
+      state['next_poll'] = now + state['interval']
+      return []
+    registry.inc('watch_polls_total', streamer=api.loginName)
+    registry.inc('watch_new_clips_total', len(new_clips), streamer=api.loginName)
+
+    # 새 클립이 생긴 속도를 최근 값에 더 무게를 두어 계산함
+    elapsed = now - state['polled_at'] if state['polled_at'] != None else state['interval']
+    state['rate'] = state['rate'] * 0.5 + (len(new_clips) / max(elapsed, 1)) * 0.5
+    state['interval'] = windowPlanner.next_poll_interval(state['rate'], minInterval, maxInterval)
+    state['polled_at'] = now
+    state['next_poll'] = now + state['interval']
+    if len(new_clips) + num_of_changed_clips > 0:
+      print(f"[{datetime.now()}] [{api.loginName}] {len(new_clips)} new clips, {num_of_changed_clips} changed clips. next poll in {state['interval']:.0f}s", flush=True)
+    clips = []
+    for clip in api.iterate_newest_incomplete_rows(lookback, minView):
+      if (api.loginName, clip['_id']) not in queued:
+        queued.add((api.loginName, clip['_id']))
+        clips.append(clip)
+    return clips
+
+  print(f"[{datetime.now()}] watching {', '.join(states.keys())}. press Ctrl-C to stop")
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    downloads = set()
+    try:
+      while True:
+        for api in apis:
+          if time.monotonic() >= states[api.loginName]['next_poll']:
+            for clip in poll(api):
+              downloads.add(executor.submit(download, api, clip))
+
+        # 다음 조회까지 기다리는 동안 끝난 다운로드의 결과를 기록함
+        timeout = max(0, min([state['next_poll'] for state in states.values()]) - time.monotonic())
+        if len(downloads) == 0:
+          time.sleep(timeout)
+          continue
+        (done, downloads) = wait(downloads, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+          try:
+            (api, clip) = future.result()
+          except Exception as e:
+            print(f"\n[{datetime.now()}] download error {e}", flush=True)
+            continue
+          record(api, clip)
+          if clip['download_status'] == 1:
+            print(f"[{datetime.now()}] [{api.loginName}] success to download {clip['created_at']} {clip['title']}", flush=True)
+    except KeyboardInterrupt:
+      print("KeyboardInterrupt! wait for currently running downloads.")
+      executor.shutdown(wait=True, cancel_futures=True)
+      for future in downloads:
+        if future.done() and not future.cancelled() and future.exception() == None:
+          (api, clip) = future.result()
+          record(api, clip)
+      print("KeyboardInterrupt! exit")
+    finally:
+      for api in apis:
+        api.database.flush()
@@ -0,0 +1,192 @@
+from datetime import datetime, timedelta
+
+
+# helix는 한 번의 조회(started_at ~ ended_at)에 대해
+# 약 1000개까지만 페이지를 넘겨주고 그 뒤는 잘라버림.
+RESULT_CAP = 1000
+# 결과가 이 값 이상이면 잘렸을 수 있으므로 구간을 나눠서 다시 요청함
+SPLIT_THRESHOLD = 900
+# 기록된 클립 수의 합이 이 값 이하인 연속된 달은 하나의 요청으로 합침
+MERGE_THRESHOLD = 500
+# 이보다 짧은 구간은 더 이상 나누지 않음
+MIN_WINDOW = timedelta(minutes=10)
+# 구간 끝에 더해서 경계에서 누락되는 클립이 없도록 함
+WINDOW_OVERLAP = timedelta(minutes=5)
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def format_date(date: datetime) -> str:
+  return date.strftime(DATE_FORMAT)
+
+
+def parse_date(date: str) -> datetime:
+  return datetime.strptime(date, DATE_FORMAT)
+
+
+def month_windows(start_year: int, start_month: int, today: datetime = None) -> list:
+  """
+  start_year-start_month부터 이번 달까지의
+  [월 시작, 다음 월 시작) 구간 목록
+  """
+  today = today if today != None else datetime.now()
+  windows = []
+  year, month = start_year, start_month
+  while (year, month) <= (today.year, today.month):
+    started_at = datetime(year, month, 1)
+    if month == 12:
+      year, month = year + 1, 1
+    else:
+      month += 1
+    windows.append((started_at, datetime(year, month, 1)))
+  return windows
+
+
+def split_window(window: tuple, parts: int = 2) -> list:
+  (started_at, ended_at) = window
+  step = (ended_at - started_at) / parts
+  bounds = [started_at + step * i for i in range(parts)] + [ended_at]
+  # 초 단위로 맞춰서 api에 전달되는 문자열과 기록된 구간이 같도록 함
+  bounds = [bound.replace(microsecond=0) for bound in bounds]
+  return [(bounds[i], bounds[i + 1]) for i in range(parts) if bounds[i] < bounds[i + 1]]
+
+
+def is_splittable(window: tuple) -> bool:
+  (started_at, ended_at) = window
+  return (ended_at - started_at) >= MIN_WINDOW * 2
+
+
+def known_density(window: tuple, records: list):
+  """
+  database에 기록된 구간들로부터 window 안의 클립 수를 추정함.
+  window 안의 기록들이 빈틈없이 window를 덮으면 그 합을 리턴함.
+  window 밖으로 걸친 기록(합쳐서 조회한 구간 등)은 겹치는 길이만큼만 나눠서 더함.
+  알 수 없으면 None.
+
+  records: (started_at, ended_at, clip_count) 목록. started_at 오름차순.
+  """
+  (started_at, ended_at) = window
+  covered_until = started_at
+  total = 0
+  for (record_started_at, record_ended_at, clip_count) in records:
+    if record_ended_at <= started_at or record_started_at >= ended_at:
+      continue
+    if record_started_at > covered_until:
+      return None
+    covered_until = max(covered_until, record_ended_at)
+    overlap = min(ended_at, record_ended_at) - max(started_at, record_started_at)
+    total += clip_count * (overlap / (record_ended_at - record_started_at))
+  if covered_until < ended_at:
+    return None
+  return round(total)
+
+
+def plan_windows(windows: list, records: list) -> list:
+  """
+  기록된 클립 밀도에 따라서 조회 구간을 다시 짬.
+  - 클립이 많았던 달은 미리 여러 구간으로 나눔
+  - 클립이 적거나 없던 연속된 달은 하나의 구간으로 합침
+  - 기록이 없는 달은 그대로 둠
+  """
+  planned = []
+  merging = None
+  merging_count = 0
+
+  def flush():
+    nonlocal merging, merging_count
+    if merging != None:
+      planned.append(merging)
+    merging = None
+    merging_count = 0
+
+  for window in windows:
+    density = known_density(window, records)
+    if density == None:
+      flush()
+      planned.append(window)
+    elif density >= SPLIT_THRESHOLD:
+      flush()
+      parts = -(-density // MERGE_THRESHOLD)
+      planned += split_window(window, parts)
+    elif merging != None and merging[1] == window[0] and merging_count + density <= MERGE_THRESHOLD:
+      merging = (merging[0], window[1])
+      merging_count += density
+    else:
+      flush()
+      merging = window
+      merging_count = density
+  flush()
+  return planned
+
+
+# 구간이 끝난 지 (최대 일 수, 다시 조회할 간격 일 수)
+# 마지막 단계보다 오래된 구간은 조회수가 거의 변하지 않는다고 보고 다시 조회하지 않음
+DEFAULT_REFRESH_TIERS = '7:1,30:7,365:30'
+
+
+def parse_refresh_tiers(tiers: str) -> list:
+  """
+  '7:1,30:7,365:30' -> [(7일, 1일), (30일, 7일), (365일, 30일)]
+  """
+  parsed = []
+  for tier in tiers.split(','):
+    if len(tier.strip()) == 0:
+      continue
+    (max_age, interval) = tier.split(':')
+    parsed.append((timedelta(days=float(max_age)), timedelta(days=float(interval))))
+  parsed.sort()
+  if len(parsed) == 0:
+    raise Exception(f"refresh tiers is not valid: {tiers}")
+  return parsed
+
+
+def refresh_interval(window: tuple, tiers: list, now: datetime):
+  """
+  구간의 나이에 맞는 다시 조회할 간격. 갱신하지 않는 구간이면 None.
+  """
+  age = now - window[1]
+  for (max_age, interval) in tiers:
+    if age <= max_age:
+      return interval
+  return None
+
+
+def due_windows(windows: list, records: list, tiers: list, now: datetime = None) -> list:
+  """
+  조회수 갱신이 필요한 구간만 남김.
+  한 번도 조회하지 않은 부분이 있는 구간은 항상 포함함.
+
+  records: (started_at, ended_at, clip_count, updated_at) 목록
+  """
+  now = now if now != None else datetime.now()
+  due = []
+  for window in windows:
+    (started_at, ended_at) = window
+    overlapping = [record for record in records if record[0] < ended_at and record[1] > started_at]
+    covered = [(record[0], record[1], record[2]) for record in overlapping]
+    if len(overlapping) == 0 or known_density(window, covered) == None:
+      due.append(window)
+      continue
+    interval = refresh_interval(window, tiers, now)
+    if interval == None:
+      continue
+    last_crawled = min([record[3] for record in overlapping])
+    if now - last_crawled >= interval:
+      due.append(window)
+  return due
+
+
+# watch 모드에서 조회하는 최근 구간의 길이
+WATCH_LOOKBACK = timedelta(hours=1)
+# watch 모드에서 한 번 조회할 때마다 기대하는 새 클립 수
+WATCH_TARGET_CLIPS = 1
+
+
+def next_poll_interval(rate: float, minimum: float, maximum: float) -> float:
+  """
+  최근 새 클립이 생기는 속도(초당 클립 수)에 맞춘 다음 조회까지의 시간(초).
+  클립이 자주 생기면 minimum까지 자주 조회하고, 생기지 않으면 maximum까지 늘림.
+  """
+  if rate <= 0:
+    return maximum
+  return max(minimum, min(maximum, WATCH_TARGET_CLIPS / rate))